@@ -1,18 +1,32 @@
-from flask import Flask, render_template, request, jsonify, redirect, url_for, session, flash
+from flask import Flask, render_template, request, jsonify, redirect, url_for, session, flash, Response, stream_with_context, has_request_context
 from werkzeug.security import check_password_hash, generate_password_hash
 from werkzeug.utils import secure_filename
 import psycopg2
 import psycopg2.extras
+import psycopg2.extensions
+import psycopg2.pool
+import psycopg2.errors
+from psycopg2 import sql
 import requests
 import os
 import json
-from datetime import datetime
-import uuid
+import io
+import random
+import re
+import hashlib
+from datetime import datetime, date, timezone, timedelta
+from email.utils import parsedate_to_datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from decimal import Decimal
+from xml.sax.saxutils import XMLGenerator, escape
 from functools import wraps
+from collections import namedtuple
+from contextlib import contextmanager
 import boto3
 from botocore.exceptions import ClientError
 import time
 import threading
+import sys
 
 app = Flask(__name__)
 app.secret_key = os.environ.get('SECRET_KEY', 'your-secret-key-here')
@@ -26,6 +40,25 @@ DATABASE_CONFIG = {
     'port': os.environ.get('DB_PORT', '5432')
 }
 
+# Réplicas de leitura (opcional): um ou mais DSNs separados por vírgula
+DATABASE_REPLICAS = [dsn.strip() for dsn in os.environ.get('DB_REPLICA_DSN', '').split(',') if dsn.strip()]
+
+# Tamanho máximo de cada pool (primário e cada réplica) usado pela camada de acesso a dados
+POOL_CONFIG = {
+    'minimo': 1,
+    'maximo': int(os.environ.get('DB_POOL_MAX', '10')),
+    # Só testa (SELECT 1) conexões paradas no pool há mais que isso; as outras vão direto
+    'ping_ocioso_s': float(os.environ.get('DB_POOL_PING_OCIOSO', '30'))
+}
+
+REPLICA_CONFIG = {
+    # Acima desse atraso a leitura vai para o primário
+    'lag_maximo_s': float(os.environ.get('DB_REPLICA_LAG_MAXIMO', '5')),
+    'timeout_conexao': int(os.environ.get('DB_REPLICA_TIMEOUT', '3')),
+    # Por quanto tempo uma réplica que falhou deixa de ser tentada
+    'pausa_falha_s': float(os.environ.get('DB_REPLICA_PAUSA_FALHA', '30'))
+}
+
 # Configurações do Bucket Blaze
 BLAZE_CONFIG = {
     'endpoint_url': os.environ.get('BLAZE_ENDPOINT_URL'),
@@ -43,13 +76,96 @@ AUTH_CONFIG = {
 # Nome da tabela do cliente (configurável via env)
 CLIENT_TABLE = os.environ.get('CLIENT_TABLE', 'integrador_cliente01')
 
+# Perfis de saída do feed XML (selecionados via ?formato=)
+# Cada perfil define o elemento raiz, o elemento de cada veículo, o mapeamento
+# coluna -> tag e como serializar o array de fotos (tag do grupo, tag de cada foto)
+XML_PERFIS = {
+    'generico': {
+        'raiz': 'estoque',
+        'item': 'veiculo',
+        'campos': [
+            ('id', 'id'), ('tipo', 'tipo'), ('marca_nome', 'marca'), ('modelo_nome', 'modelo'),
+            ('versao_nome', 'versao'), ('ano_modelo', 'ano_modelo'), ('ano_fabricacao', 'ano_fabricacao'),
+            ('km', 'km'), ('cor', 'cor'), ('combustivel', 'combustivel'), ('cambio', 'cambio'),
+            ('motor', 'motor'), ('portas', 'portas'), ('categoria', 'categoria'),
+            ('cilindrada', 'cilindrada'), ('preco', 'preco'), ('updated_at', 'atualizado_em')
+        ],
+        'fotos': ('fotos', 'foto'),
+        'removido': 'removido'
+    },
+    'webmotors': {
+        'raiz': 'estoque',
+        'item': 'anuncio',
+        'campos': [
+            ('id', 'CodigoAnuncio'), ('tipo', 'TipoVeiculo'), ('marca_nome', 'Marca'),
+            ('modelo_nome', 'Modelo'), ('versao_nome', 'Versao'), ('ano_fabricacao', 'AnoFabricacao'),
+            ('ano_modelo', 'AnoModelo'), ('km', 'Quilometragem'), ('cor', 'Cor'),
+            ('combustivel', 'Combustivel'), ('cambio', 'Cambio'), ('portas', 'Portas'),
+            ('preco', 'Preco')
+        ],
+        'fotos': ('Fotos', 'Foto'),
+        'removido': 'AnuncioRemovido'
+    },
+    'olx': {
+        'raiz': 'ads',
+        'item': 'ad',
+        'campos': [
+            ('id', 'id'), ('tipo', 'category'), ('marca_nome', 'vehicle_brand'),
+            ('modelo_nome', 'vehicle_model'), ('versao_nome', 'vehicle_version'),
+            ('ano_modelo', 'regdate'), ('km', 'mileage'), ('cor', 'carcolor'),
+            ('combustivel', 'fuel'), ('cambio', 'gearbox'), ('portas', 'doors'),
+            ('cilindrada', 'cubiccms'), ('preco', 'price')
+        ],
+        'fotos': ('images', 'image'),
+        'removido': 'deleted_ad'
+    }
+}
+
+# Quantidade de linhas buscadas por ida ao banco no cursor do feed
+XML_ITERSIZE = int(os.environ.get('XML_ITERSIZE', '500'))
+
+# Configurações do cliente da API FIPE (concorrência adaptativa, retry e circuit breaker)
+FIPE_CONFIG = {
+    'timeout': int(os.environ.get('FIPE_TIMEOUT', '10')),
+    'concorrencia_inicial': int(os.environ.get('FIPE_CONCORRENCIA_INICIAL', '4')),
+    'concorrencia_min': 1,
+    'concorrencia_max': int(os.environ.get('FIPE_CONCORRENCIA_MAX', '8')),
+    'tentativas': int(os.environ.get('FIPE_TENTATIVAS', '5')),
+    'backoff_base': 0.5,
+    'backoff_max': 30.0,
+    'limiar_circuito': int(os.environ.get('FIPE_LIMIAR_CIRCUITO', '10')),
+    'pausa_circuito': float(os.environ.get('FIPE_PAUSA_CIRCUITO', '60')),
+    # Quanto uma chamada espera o circuito fechar antes de desistir (e ir para o dead-letter)
+    'espera_max_circuito': float(os.environ.get('FIPE_ESPERA_MAX_CIRCUITO', '900'))
+}
+
+# Coleta de fotos órfãs no bucket
+GC_CONFIG = {
+    # Objetos mais novos que isso nunca são apagados (upload em andamento, formulário aberto)
+    'carencia_horas': float(os.environ.get('GC_CARENCIA_HORAS', '24')),
+    # Abaixo disso a coleta pegaria uploads de formulários ainda abertos
+    'carencia_minima_horas': float(os.environ.get('GC_CARENCIA_MINIMA_HORAS', '1')),
+    # Restringe a coleta a um prefixo do bucket ('' = bucket inteiro)
+    'prefixo': os.environ.get('GC_PREFIXO', ''),
+    # delete_objects aceita no máximo 1000 chaves por chamada
+    'lote': 1000,
+    # Chave do advisory lock que serializa os lotes do GC com as gravações de veículos
+    'trava': 7316001,
+    # Quanto GC e gravações esperam pela trava (e pelos locks da transação) antes de desistir
+    'espera_trava_s': float(os.environ.get('GC_ESPERA_TRAVA_S', '30'))
+}
+
 # Variável global para controlar o status da importação
 importacao_status = {
     'em_andamento': False,
     'progresso': 0,
     'total': 0,
     'atual': '',
-    'erro': None
+    'erro': None,
+    'inseridos': 0,
+    'atualizados': 0,
+    'inalterados': 0,
+    'falhas': 0
 }
 
 # Configuração do S3 (Bucket Blaze)
@@ -71,129 +187,1199 @@ def login_required(f):
     return decorated_function
 
 # Conexão com banco de dados
-def get_db_connection():
-    return psycopg2.connect(**DATABASE_CONFIG)
+# Todas as conexões saem de pools (um para o primário e um por réplica); close() devolve
+# a conexão ao pool. O pool guarda referência às conexões emprestadas, então uma conexão
+# esquecida nunca é coletada: quem escreve usa `with conexao()`, que devolve mesmo com erro
+class ConexaoPreparada(psycopg2.extensions.connection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Prepared statements já criados nesta conexão (ver executar_preparada)
+        self.preparados = set()
+        self.pool = None
+        # DSN da réplica de origem; None para o primário
+        self.replica = None
+        self.devolvida_em = time.monotonic()
+    
+    def close(self):
+        pool, self.pool = self.pool, None
+        if pool is None:
+            super().close()
+        else:
+            self.devolvida_em = time.monotonic()
+            # putconn faz rollback de transação aberta e fecha conexões quebradas
+            pool.putconn(self, close=bool(self.closed))
 
-# Inicialização do banco de dados
-def init_db():
+class PoolConexoes(psycopg2.pool.ThreadedConnectionPool):
+    # O ThreadedConnectionPool só guarda até minconn conexões ociosas e fecha as outras
+    # no putconn, perdendo os prepared statements delas. Aqui guarda até maxconn.
+    # putconn já chama _putconn com o lock do pool, então a troca de minconn é segura
+    def _putconn(self, conn, key=None, close=False):
+        minimo, self.minconn = self.minconn, self.maxconn
+        try:
+            super()._putconn(conn, key, close)
+        finally:
+            self.minconn = minimo
+
+pools = {}
+pools_lock = threading.Lock()
+
+# Réplicas marcadas como indisponíveis: dsn -> instante (monotonic) até quando evitar
+replicas_indisponiveis = {}
+
+def obter_pool(dsn=None):
+    # dsn None = primário
+    with pools_lock:
+        pool = pools.get(dsn)
+        if pool is None:
+            if dsn is None:
+                pool = PoolConexoes(
+                    POOL_CONFIG['minimo'], POOL_CONFIG['maximo'],
+                    connection_factory=ConexaoPreparada, **DATABASE_CONFIG
+                )
+            else:
+                pool = PoolConexoes(
+                    POOL_CONFIG['minimo'], POOL_CONFIG['maximo'], dsn,
+                    connection_factory=ConexaoPreparada, connect_timeout=REPLICA_CONFIG['timeout_conexao']
+                )
+            pools[dsn] = pool
+        return pool
+
+def conexao_viva(conn):
     try:
-        conn = get_db_connection()
         cursor = conn.cursor()
-        
-        # Tabela principal da FIPE
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS integrador (
-                id SERIAL PRIMARY KEY,
-                tipo VARCHAR(10) NOT NULL CHECK (tipo IN ('carros', 'motos')),
-                marca_id INTEGER,
-                marca_nome VARCHAR(100),
-                modelo_id INTEGER,
-                modelo_nome VARCHAR(200),
-                versao_id VARCHAR(50),
-                versao_nome VARCHAR(300),
-                ano_modelo INTEGER,
-                combustivel VARCHAR(50),
-                motor VARCHAR(100),
-                portas INTEGER,
-                categoria VARCHAR(100),
-                cilindrada VARCHAR(50),
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                UNIQUE(tipo, marca_id, modelo_id, versao_id, ano_modelo)
-            )
-        ''')
-        
-        # Tabela dinâmica do cliente
-        cursor.execute(f'''
-            CREATE TABLE IF NOT EXISTS {CLIENT_TABLE} (
-                id SERIAL PRIMARY KEY,
-                tipo VARCHAR(10) NOT NULL CHECK (tipo IN ('carros', 'motos')),
-                marca_id INTEGER,
-                marca_nome VARCHAR(100),
-                modelo_id INTEGER,
-                modelo_nome VARCHAR(200),
-                versao_id VARCHAR(50),
-                versao_nome VARCHAR(300),
-                ano_modelo INTEGER,
-                ano_fabricacao INTEGER,
-                km INTEGER,
-                cor VARCHAR(50),
-                combustivel VARCHAR(50),
-                cambio VARCHAR(50),
-                motor VARCHAR(100),
-                portas INTEGER,
-                categoria VARCHAR(100),
-                cilindrada VARCHAR(50),
-                preco DECIMAL(12,2),
-                fotos TEXT[],
-                ativo BOOLEAN DEFAULT TRUE,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        conn.commit()
+        cursor.execute('SELECT 1')
         cursor.close()
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+def pegar_do_pool(dsn=None):
+    # Conexões paradas há muito tempo são testadas antes de sair, e as que morreram (ex.:
+    # depois de um restart do banco) são descartadas. As usadas há pouco saem sem teste,
+    # para não somar idas e voltas a cada requisição; se uma delas tiver caído, a
+    # leitura é repetida em executar_leitura. None quando o pool está esgotado
+    pool = obter_pool(dsn)
+    for _ in range(POOL_CONFIG['maximo'] + 1):
+        try:
+            conn = pool.getconn()
+        except psycopg2.pool.PoolError:
+            return None
+        conn.pool = pool
+        conn.replica = dsn
+        if time.monotonic() - conn.devolvida_em < POOL_CONFIG['ping_ocioso_s'] or conexao_viva(conn):
+            return conn
+        descartar_conexao(conn)
+    return None
+
+def descartar_conexao(conn):
+    pool, conn.pool = conn.pool, None
+    if pool is None:
         conn.close()
+    else:
+        pool.putconn(conn, close=True)
+
+def get_db_connection(leitura=False):
+    # Rotas só de leitura passam leitura=True e podem cair numa réplica;
+    # sem réplica saudável (ou atualizada o bastante para a sessão) usa o primário
+    if leitura and DATABASE_REPLICAS:
+        lsn_minimo = session.get('lsn_escrita') if has_request_context() else None
+        conn = conectar_replica(lsn_minimo)
+        if conn:
+            return conn
+    
+    conn = pegar_do_pool()
+    if conn is None:
+        # Pool esgotado: conexão avulsa, fechada de verdade no close()
+        conn = psycopg2.connect(connection_factory=ConexaoPreparada, **DATABASE_CONFIG)
+    return conn
+
+@contextmanager
+def conexao(leitura=False):
+    conn = get_db_connection(leitura)
+    try:
+        yield conn
+    except Exception:
+        # Solta na hora os locks da transação (advisory, LOCK TABLE do trigger)
+        if not conn.closed:
+            conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+# Falhas de consulta na réplica que valem repetir no primário (conexão perdida,
+# consulta cancelada por conflito de recovery)
+ERROS_REPLICA = (psycopg2.OperationalError, psycopg2.errors.SerializationFailure)
+
+def executar_leitura(funcao):
+    # Roda funcao(conn) numa conexão de leitura; se ela veio de uma réplica e a
+    # consulta falhar lá, ou se a conexão do pool estava morta, repete no primário
+    conn = get_db_connection(leitura=True)
+    try:
+        return funcao(conn)
+    except ERROS_REPLICA as e:
+        if conn.replica is None and not conn.closed:
+            raise
+        origem = 'na réplica' if conn.replica else 'com a conexão perdida'
+        print(f"Leitura falhou {origem}, repetindo no primário: {e}")
+    finally:
+        conn.close()
+    
+    with conexao() as conn:
+        return funcao(conn)
+
+def conectar_replica(lsn_minimo=None):
+    dsns = DATABASE_REPLICAS[:]
+    random.shuffle(dsns)
+    
+    for dsn in dsns:
+        if time.monotonic() < replicas_indisponiveis.get(dsn, 0):
+            continue
+        
+        conn = None
+        try:
+            conn = pegar_do_pool(dsn)
+            if conn is None:
+                continue
+            if not conn.readonly:
+                conn.set_session(readonly=True)
+            if replica_atualizada(conn, lsn_minimo):
+                return conn
+            conn.close()
+        except psycopg2.Error as e:
+            print(f"Réplica indisponível, usando outra/primário: {e}")
+            replicas_indisponiveis[dsn] = time.monotonic() + REPLICA_CONFIG['pausa_falha_s']
+            if conn:
+                descartar_conexao(conn)
+    
+    return None
+
+def replica_atualizada(conn, lsn_minimo=None):
+    # Só conta atraso zero (tudo que foi recebido já foi aplicado) se o WAL receiver estiver
+    # conectado ao primário; sem ele a réplica aplica o que tinha e fica parada para sempre.
+    # pg_stat_wal_receiver só tem linha quando o receiver está de pé (o pid é visível a todos).
+    # lsn_minimo garante read-your-writes: a réplica precisa ter aplicado a última escrita da sessão
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT
+            pg_is_in_recovery(),
+            EXISTS (SELECT 1 FROM pg_stat_wal_receiver),
+            CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                 ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+            END,
+            %s::pg_lsn IS NULL OR pg_last_wal_replay_lsn() >= %s::pg_lsn
+    ''', (lsn_minimo, lsn_minimo))
+    em_recuperacao, receiver_conectado, atraso, alcancou_escrita = cursor.fetchone()
+    cursor.close()
+    
+    return bool(
+        em_recuperacao and receiver_conectado and alcancou_escrita
+        and atraso <= REPLICA_CONFIG['lag_maximo_s']
+    )
+
+def registrar_escrita(conn):
+    # Guarda na sessão a posição do WAL depois do commit, para as próximas
+    # leituras desta sessão só usarem réplicas que já a aplicaram
+    if not DATABASE_REPLICAS or not has_request_context():
+        return
+    cursor = conn.cursor()
+    cursor.execute('SELECT pg_current_wal_lsn()::text')
+    session['lsn_escrita'] = cursor.fetchone()[0]
+    cursor.close()
+
+# Inicialização do banco de dados
+def init_db():
+    try:
+        with conexao() as conn:
+            cursor = conn.cursor()
+            
+            # Tabela principal da FIPE
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS integrador (
+                    id SERIAL PRIMARY KEY,
+                    tipo VARCHAR(10) NOT NULL CHECK (tipo IN ('carros', 'motos')),
+                    marca_id INTEGER,
+                    marca_nome VARCHAR(100),
+                    modelo_id INTEGER,
+                    modelo_nome VARCHAR(200),
+                    versao_id VARCHAR(50),
+                    versao_nome VARCHAR(300),
+                    ano_modelo INTEGER,
+                    combustivel VARCHAR(50),
+                    motor VARCHAR(100),
+                    portas INTEGER,
+                    categoria VARCHAR(100),
+                    cilindrada VARCHAR(50),
+                    hash_conteudo CHAR(32),
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    UNIQUE(tipo, marca_id, modelo_id, versao_id, ano_modelo)
+                )
+            ''')
+            
+            # Bases criadas antes do hash de conteúdo
+            cursor.execute('ALTER TABLE integrador ADD COLUMN IF NOT EXISTS hash_conteudo CHAR(32)')
+            cursor.execute('ALTER TABLE integrador ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP')
+            
+            # Estatísticas do catálogo, atualizadas ao fim de cada importação
+            # (o índice único é exigido pelo REFRESH ... CONCURRENTLY)
+            cursor.execute('''
+                CREATE MATERIALIZED VIEW IF NOT EXISTS integrador_estatisticas AS
+                SELECT
+                    tipo,
+                    COALESCE(marca_id, 0) AS marca_id,
+                    MAX(marca_nome) AS marca_nome,
+                    COALESCE(ano_modelo, 0) AS ano_modelo,
+                    COUNT(*) AS quantidade
+                FROM integrador
+                GROUP BY tipo, COALESCE(marca_id, 0), COALESCE(ano_modelo, 0)
+            ''')
+            cursor.execute('''
+                CREATE UNIQUE INDEX IF NOT EXISTS integrador_estatisticas_chave
+                ON integrador_estatisticas (tipo, marca_id, ano_modelo)
+            ''')
+            cursor.execute('CREATE INDEX IF NOT EXISTS integrador_created_at_idx ON integrador (created_at DESC)')
+            
+            # Nós da FIPE que falharam na importação (reprocessados depois, sem refazer o crawl)
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS integrador_falhas (
+                    id SERIAL PRIMARY KEY,
+                    chave VARCHAR(200) NOT NULL UNIQUE,
+                    nivel VARCHAR(10) NOT NULL CHECK (nivel IN ('marca', 'modelo', 'ano')),
+                    tipo VARCHAR(10) NOT NULL,
+                    marca_id INTEGER,
+                    marca_nome VARCHAR(100),
+                    modelo_id INTEGER,
+                    modelo_nome VARCHAR(200),
+                    ano_codigo VARCHAR(50),
+                    erro TEXT,
+                    tentativas INTEGER DEFAULT 1,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            
+            # Tabela dinâmica do cliente
+            cursor.execute(f'''
+                CREATE TABLE IF NOT EXISTS {CLIENT_TABLE} (
+                    id SERIAL PRIMARY KEY,
+                    tipo VARCHAR(10) NOT NULL CHECK (tipo IN ('carros', 'motos')),
+                    marca_id INTEGER,
+                    marca_nome VARCHAR(100),
+                    modelo_id INTEGER,
+                    modelo_nome VARCHAR(200),
+                    versao_id VARCHAR(50),
+                    versao_nome VARCHAR(300),
+                    ano_modelo INTEGER,
+                    ano_fabricacao INTEGER,
+                    km INTEGER,
+                    cor VARCHAR(50),
+                    combustivel VARCHAR(50),
+                    cambio VARCHAR(50),
+                    motor VARCHAR(100),
+                    portas INTEGER,
+                    categoria VARCHAR(100),
+                    cilindrada VARCHAR(50),
+                    preco DECIMAL(12,2),
+                    fotos TEXT[],
+                    ativo BOOLEAN DEFAULT TRUE,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            
+            # Log de alterações do cliente (base do feed incremental ?since=)
+            cursor.execute(f'''
+                CREATE TABLE IF NOT EXISTS {CLIENT_TABLE}_alteracoes (
+                    seq BIGSERIAL PRIMARY KEY,
+                    veiculo_id INTEGER NOT NULL,
+                    operacao VARCHAR(12) NOT NULL
+                        CHECK (operacao IN ('insert', 'update', 'ativacao', 'desativacao', 'delete')),
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            
+            # O LOCK serializa quem grava no log: assim a ordem de seq é a ordem de commit
+            # e um consumidor nunca perde uma alteração que comitou depois de uma seq maior
+            cursor.execute(f'''
+                CREATE OR REPLACE FUNCTION {CLIENT_TABLE}_registrar_alteracao() RETURNS TRIGGER AS $$
+                BEGIN
+                    LOCK TABLE {CLIENT_TABLE}_alteracoes IN EXCLUSIVE MODE;
+                    IF TG_OP = 'DELETE' THEN
+                        INSERT INTO {CLIENT_TABLE}_alteracoes (veiculo_id, operacao) VALUES (OLD.id, 'delete');
+                        RETURN OLD;
+                    ELSIF TG_OP = 'INSERT' THEN
+                        INSERT INTO {CLIENT_TABLE}_alteracoes (veiculo_id, operacao) VALUES (NEW.id, 'insert');
+                    ELSIF OLD.ativo IS DISTINCT FROM NEW.ativo THEN
+                        INSERT INTO {CLIENT_TABLE}_alteracoes (veiculo_id, operacao)
+                        VALUES (NEW.id, CASE WHEN NEW.ativo THEN 'ativacao' ELSE 'desativacao' END);
+                    ELSE
+                        INSERT INTO {CLIENT_TABLE}_alteracoes (veiculo_id, operacao) VALUES (NEW.id, 'update');
+                    END IF;
+                    RETURN NEW;
+                END;
+                $$ LANGUAGE plpgsql
+            ''')
+            
+            cursor.execute(f'DROP TRIGGER IF EXISTS {CLIENT_TABLE}_alteracoes_trg ON {CLIENT_TABLE}')
+            cursor.execute(f'''
+                CREATE TRIGGER {CLIENT_TABLE}_alteracoes_trg
+                AFTER INSERT OR UPDATE OR DELETE ON {CLIENT_TABLE}
+                FOR EACH ROW EXECUTE FUNCTION {CLIENT_TABLE}_registrar_alteracao()
+            ''')
+            
+            # Índice dos objetos já enviados ao bucket, endereçados pelo SHA-256 do conteúdo
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS fotos_objetos (
+                    hash CHAR(64) PRIMARY KEY,
+                    chave VARCHAR(300) NOT NULL,
+                    url TEXT NOT NULL,
+                    tamanho INTEGER,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            
+            # Quais veículos do cliente usam cada objeto
+            cursor.execute(f'''
+                CREATE TABLE IF NOT EXISTS {CLIENT_TABLE}_fotos (
+                    veiculo_id INTEGER NOT NULL REFERENCES {CLIENT_TABLE}(id) ON DELETE CASCADE,
+                    url TEXT NOT NULL,
+                    chave VARCHAR(300),
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (veiculo_id, url)
+                )
+            ''')
+            cursor.execute(f'CREATE INDEX IF NOT EXISTS {CLIENT_TABLE}_fotos_chave_idx ON {CLIENT_TABLE}_fotos (chave)')
+            
+            # Preenche as referências das fotos cadastradas antes da tabela existir
+            marcador = f"/{BLAZE_CONFIG['bucket_name']}/"
+            cursor.execute(f'''
+                INSERT INTO {CLIENT_TABLE}_fotos (veiculo_id, url, chave)
+                SELECT v.id, f.url, CASE WHEN strpos(f.url, %s) > 0 THEN substr(f.url, strpos(f.url, %s) + %s) END
+                FROM {CLIENT_TABLE} v, unnest(v.fotos) AS f(url)
+                WHERE NOT EXISTS (SELECT 1 FROM {CLIENT_TABLE}_fotos)
+                ON CONFLICT (veiculo_id, url) DO NOTHING
+            ''', (marcador, marcador, len(marcador)))
+            
+            conn.commit()
+            cursor.close()
         print("Banco de dados inicializado com sucesso!")
         
     except Exception as e:
         print(f"Erro ao inicializar banco: {e}")
 
 # API FIPE
+class FipeErro(Exception):
+    pass
+
+class CircuitoAberto(FipeErro):
+    pass
+
+class ControleFipe:
+    # Limita as requisições simultâneas à FIPE e ajusta o limite em AIMD:
+    # sobe 1 a cada janela de sucessos, cai pela metade quando há erro.
+    # Com muitos erros seguidos abre o circuito: as chamadas esperam a pausa e
+    # depois uma única requisição de teste (meio aberto) decide se fecha ou reabre
+    def __init__(self, config):
+        self.config = config
+        self.limite = config['concorrencia_inicial']
+        self.em_uso = 0
+        self.sucessos = 0
+        self.falhas_consecutivas = 0
+        self.pausa_ate = 0.0
+        self.aberto_ate = 0.0
+        self.meio_aberto = False
+        self.ultima_reducao = 0.0
+        self._cond = threading.Condition()
+    
+    def adquirir(self):
+        with self._cond:
+            desistir_em = time.monotonic() + self.config['espera_max_circuito']
+            while True:
+                agora = time.monotonic()
+                if agora < self.aberto_ate or self.meio_aberto:
+                    if agora >= desistir_em:
+                        raise CircuitoAberto('API FIPE indisponível, circuito aberto')
+                    if agora < self.aberto_ate:
+                        self._cond.wait(min(self.aberto_ate, desistir_em) - agora)
+                        continue
+                    # Meio aberto: só passa a requisição de teste, sozinha
+                    if self.em_uso > 0:
+                        self._cond.wait(desistir_em - agora)
+                        continue
+                    self.em_uso += 1
+                    return
+                if agora < self.pausa_ate:
+                    self._cond.wait(self.pausa_ate - agora)
+                    continue
+                if self.em_uso < self.limite:
+                    self.em_uso += 1
+                    return
+                self._cond.wait()
+    
+    def liberar(self, sucesso):
+        with self._cond:
+            self.em_uso -= 1
+            agora = time.monotonic()
+            
+            if self.meio_aberto and agora >= self.aberto_ate:
+                # Resultado da requisição de teste
+                if sucesso:
+                    self.meio_aberto = False
+                else:
+                    self.aberto_ate = agora + self.config['pausa_circuito']
+            
+            if sucesso:
+                self.falhas_consecutivas = 0
+                self.sucessos += 1
+                if self.sucessos >= self.limite and self.limite < self.config['concorrencia_max']:
+                    self.limite += 1
+                    self.sucessos = 0
+            else:
+                self.sucessos = 0
+                self.falhas_consecutivas += 1
+                # Uma redução por segundo, senão uma rajada de erros derruba o limite direto para o mínimo
+                if agora - self.ultima_reducao >= 1.0:
+                    self.limite = max(self.config['concorrencia_min'], self.limite // 2)
+                    self.ultima_reducao = agora
+                if self.falhas_consecutivas >= self.config['limiar_circuito'] and not self.meio_aberto:
+                    self.aberto_ate = agora + self.config['pausa_circuito']
+                    self.meio_aberto = True
+            
+            self._cond.notify_all()
+    
+    def pausar(self, segundos):
+        # Retry-After vale para todas as threads, não só para quem recebeu o 429
+        with self._cond:
+            self.pausa_ate = max(self.pausa_ate, time.monotonic() + segundos)
+            self._cond.notify_all()
+    
+    def estado(self):
+        with self._cond:
+            return {
+                'concorrencia': self.limite,
+                'em_uso': self.em_uso,
+                'falhas_consecutivas': self.falhas_consecutivas,
+                'circuito_aberto': time.monotonic() < self.aberto_ate,
+                'circuito_meio_aberto': self.meio_aberto and time.monotonic() >= self.aberto_ate
+            }
+
+def ler_retry_after(valor):
+    # Retry-After pode vir em segundos ou como data HTTP
+    if not valor:
+        return None
+    try:
+        return max(0.0, float(valor))
+    except ValueError:
+        pass
+    try:
+        data = parsedate_to_datetime(valor)
+        return max(0.0, (data - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
 class FipeAPI:
     BASE_URL = "https://parallelum.com.br/fipe/api/v1"
+    controle = ControleFipe(FIPE_CONFIG)
+    
+    @staticmethod
+    def requisitar(endpoint, vazio):
+        # Retorna o JSON da resposta, `vazio` em 404 e levanta FipeErro quando
+        # esgota as tentativas (429, 5xx, timeout, falha de conexão)
+        config = FIPE_CONFIG
+        controle = FipeAPI.controle
+        ultimo_erro = None
+        
+        for tentativa in range(config['tentativas']):
+            controle.adquirir()
+            retry_after = None
+            try:
+                response = requests.get(endpoint, timeout=config['timeout'])
+            except requests.RequestException as e:
+                controle.liberar(False)
+                ultimo_erro = f'{type(e).__name__}: {e}'
+            else:
+                if response.status_code == 200:
+                    controle.liberar(True)
+                    try:
+                        return response.json()
+                    except ValueError:
+                        raise FipeErro(f'Resposta inválida em {endpoint}')
+                
+                if response.status_code == 404:
+                    controle.liberar(True)
+                    return vazio
+                
+                if response.status_code != 429 and response.status_code < 500:
+                    controle.liberar(True)
+                    raise FipeErro(f'HTTP {response.status_code} em {endpoint}')
+                
+                controle.liberar(False)
+                ultimo_erro = f'HTTP {response.status_code}'
+                retry_after = ler_retry_after(response.headers.get('Retry-After'))
+            
+            if tentativa + 1 < config['tentativas']:
+                if retry_after is not None:
+                    controle.pausar(retry_after)
+                else:
+                    # Backoff exponencial com jitter completo
+                    teto = min(config['backoff_max'], config['backoff_base'] * 2 ** tentativa)
+                    time.sleep(random.uniform(0, teto))
+        
+        raise FipeErro(f'{ultimo_erro} em {endpoint} após {config["tentativas"]} tentativas')
     
     @staticmethod
     def get_marcas(tipo):
         endpoint = f"{FipeAPI.BASE_URL}/{tipo}/marcas"
-        try:
-            response = requests.get(endpoint, timeout=10)
-            return response.json() if response.status_code == 200 else []
-        except:
-            return []
+        return FipeAPI.requisitar(endpoint, [])
     
     @staticmethod
     def get_modelos(tipo, marca_id):
         endpoint = f"{FipeAPI.BASE_URL}/{tipo}/marcas/{marca_id}/modelos"
-        try:
-            response = requests.get(endpoint, timeout=10)
-            return response.json().get('modelos', []) if response.status_code == 200 else []
-        except:
-            return []
+        return FipeAPI.requisitar(endpoint, {}).get('modelos', [])
     
     @staticmethod
     def get_anos(tipo, marca_id, modelo_id):
         endpoint = f"{FipeAPI.BASE_URL}/{tipo}/marcas/{marca_id}/modelos/{modelo_id}/anos"
-        try:
-            response = requests.get(endpoint, timeout=10)
-            return response.json() if response.status_code == 200 else []
-        except:
-            return []
+        return FipeAPI.requisitar(endpoint, [])
     
     @staticmethod
     def get_detalhes(tipo, marca_id, modelo_id, ano_codigo):
         endpoint = f"{FipeAPI.BASE_URL}/{tipo}/marcas/{marca_id}/modelos/{modelo_id}/anos/{ano_codigo}"
-        try:
-            response = requests.get(endpoint, timeout=10)
-            return response.json() if response.status_code == 200 else {}
-        except:
-            return {}
+        return FipeAPI.requisitar(endpoint, {})
 
 # Upload de imagens
+def url_do_objeto(chave):
+    return f"{BLAZE_CONFIG['endpoint_url']}/{BLAZE_CONFIG['bucket_name']}/{chave}"
+
+def chave_da_url(url):
+    # Usa só o trecho depois de /<bucket>/ para não depender do endpoint configurado
+    marcador = f"/{BLAZE_CONFIG['bucket_name']}/"
+    if not url or marcador not in url:
+        return None
+    return url.split(marcador, 1)[1]
+
+def hash_arquivo(file):
+    file.seek(0)
+    sha = hashlib.sha256()
+    tamanho = 0
+    for bloco in iter(lambda: file.read(1024 * 1024), b''):
+        sha.update(bloco)
+        tamanho += len(bloco)
+    file.seek(0)
+    return sha.hexdigest(), tamanho
+
+def objeto_existe(s3_client, chave):
+    try:
+        s3_client.head_object(Bucket=BLAZE_CONFIG['bucket_name'], Key=chave)
+        return True
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+            return False
+        raise
+
 def upload_to_blaze(file, filename):
+    # A chave do objeto é o hash do conteúdo: bytes repetidos nunca são reenviados.
+    # Consulta primeiro o índice local (fotos_objetos) e depois um HEAD no bucket.
+    # Usa transações próprias e curtas: nada fica aberto no banco durante o I/O com o S3
     try:
+        hash_conteudo, tamanho = hash_arquivo(file)
+        
+        with conexao() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT url FROM fotos_objetos WHERE hash = %s', (hash_conteudo,))
+            row = cursor.fetchone()
+            cursor.close()
+        if row:
+            return row[0]
+        
+        extensao = os.path.splitext(secure_filename(filename))[1].lower()
+        chave = f"fotos/{hash_conteudo}{extensao}"
+        
         s3_client = get_s3_client()
-        s3_client.upload_fileobj(
-            file,
-            BLAZE_CONFIG['bucket_name'],
-            filename,
-            ExtraArgs={'ACL': 'public-read'}
-        )
-        return f"{BLAZE_CONFIG['endpoint_url']}/{BLAZE_CONFIG['bucket_name']}/{filename}"
+        if not objeto_existe(s3_client, chave):
+            s3_client.upload_fileobj(
+                file,
+                BLAZE_CONFIG['bucket_name'],
+                chave,
+                ExtraArgs={'ACL': 'public-read'}
+            )
+        
+        url = url_do_objeto(chave)
+        with conexao() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                INSERT INTO fotos_objetos (hash, chave, url, tamanho)
+                VALUES (%s, %s, %s, %s)
+                ON CONFLICT (hash) DO NOTHING
+            ''', (hash_conteudo, chave, url, tamanho))
+            conn.commit()
+            cursor.close()
+        return url
     except Exception as e:
         print(f"Erro no upload: {e}")
         return None
 
+def sincronizar_referencias_fotos(cursor, veiculo_id, fotos):
+    cursor.execute(
+        f'DELETE FROM {CLIENT_TABLE}_fotos WHERE veiculo_id = %s AND NOT (url = ANY(%s))',
+        (veiculo_id, fotos)
+    )
+    if fotos:
+        psycopg2.extras.execute_values(cursor, f'''
+            INSERT INTO {CLIENT_TABLE}_fotos (veiculo_id, url, chave) VALUES %s
+            ON CONFLICT (veiculo_id, url) DO NOTHING
+        ''', [(veiculo_id, url, chave_da_url(url)) for url in fotos])
+
+def travar_fotos(cursor, exclusiva=False):
+    # Lotes do GC pegam a trava exclusiva e as transações que gravam referências a
+    # fotos pegam a compartilhada; as duas valem até o fim da transação. O lock_timeout
+    # (também local à transação) evita esperar para sempre por quem ficou preso com ela;
+    # estourado, levanta psycopg2.errors.LockNotAvailable
+    cursor.execute(
+        "SELECT set_config('lock_timeout', %s, true)",
+        (f"{int(GC_CONFIG['espera_trava_s'] * 1000)}ms",)
+    )
+    funcao = 'pg_advisory_xact_lock' if exclusiva else 'pg_advisory_xact_lock_shared'
+    cursor.execute(f'SELECT {funcao}(%s)', (GC_CONFIG['trava'],))
+
+def garantir_fotos_enviadas(cursor, enviadas):
+    # Roda com a trava compartilhada já tomada. Um lote do GC pode ter apagado um
+    # objeto reaproveitado pelo dedup entre o upload e esta transação; nesse caso a
+    # linha do índice sumiu junto e o arquivo é enviado de novo (mesma URL)
+    if not enviadas:
+        return
+    cursor.execute('SELECT url FROM fotos_objetos WHERE url = ANY(%s)', (list(enviadas),))
+    presentes = {row[0] for row in cursor.fetchall()}
+    for url, file in enviadas.items():
+        if url not in presentes and upload_to_blaze(file, file.filename) is None:
+            raise Exception(f'Falha ao reenviar a foto {file.filename}')
+
+# Coleta de fotos órfãs
+gc_status = {
+    'em_andamento': False,
+    'resultado': None,
+    'erro': None
+}
+
+def tabelas_com_fotos(cursor):
+    # Todas as tabelas de cliente (qualquer tenant) que têm um array de fotos
+    cursor.execute('''
+        SELECT table_name FROM information_schema.columns
+        WHERE table_schema = current_schema() AND column_name = 'fotos' AND data_type = 'ARRAY'
+    ''')
+    return [row[0] for row in cursor.fetchall()]
+
+def chaves_referenciadas(cursor, tabelas, chaves=None):
+    # Chaves do bucket usadas em algum array de fotos; com `chaves`, só verifica essas
+    referenciadas = set()
+    for tabela in tabelas:
+        consulta = sql.SQL('SELECT DISTINCT f.url FROM {}, unnest(fotos) AS f(url)').format(sql.Identifier(tabela))
+        if chaves is None:
+            cursor.execute(consulta)
+        else:
+            cursor.execute(
+                consulta + sql.SQL(' WHERE f.url LIKE ANY(%s)'),
+                (['%/' + chave for chave in chaves],)
+            )
+        for (url,) in cursor.fetchall():
+            chave = chave_da_url(url)
+            if chave:
+                referenciadas.add(chave)
+    return referenciadas
+
+def excluir_lote_orfaos(s3_client, conn, tabelas, objetos, dry_run, metricas):
+    cursor = conn.cursor()
+    
+    try:
+        # Com a trava exclusiva nenhuma gravação de veículo está em andamento: a
+        # conferência abaixo vê todas as referências já gravadas e nenhuma nova aparece
+        # até o delete no bucket terminar. A simulação não apaga nada e não trava
+        if not dry_run:
+            try:
+                travar_fotos(cursor, exclusiva=True)
+            except psycopg2.errors.LockNotAvailable:
+                print(f"GC de fotos: trava ocupada, {len(objetos)} objetos ficam para a próxima execução")
+                metricas['adiados'] += len(objetos)
+                return
+        
+        # Confere de novo: a foto pode ter sido reaproveitada (dedup) depois da primeira leitura
+        ainda_usadas = chaves_referenciadas(cursor, tabelas, [obj['Key'] for obj in objetos])
+        objetos = [obj for obj in objetos if obj['Key'] not in ainda_usadas]
+        metricas['orfaos'] += len(objetos)
+        
+        if dry_run or not objetos:
+            return
+        
+        chaves = [obj['Key'] for obj in objetos]
+        
+        # Tira do índice junto com o delete, para o upload não devolver uma URL que sumiu.
+        # Se o S3 falhar o índice sai mesmo assim: o próximo upload acha o objeto pelo HEAD
+        cursor.execute('DELETE FROM fotos_objetos WHERE chave = ANY(%s)', (chaves,))
+        resposta = s3_client.delete_objects(
+            Bucket=BLAZE_CONFIG['bucket_name'],
+            Delete={'Objects': [{'Key': chave} for chave in chaves], 'Quiet': True}
+        )
+    finally:
+        # O commit solta a trava (numa transação abortada vira rollback)
+        conn.commit()
+        cursor.close()
+    
+    falharam = {erro['Key'] for erro in resposta.get('Errors', [])}
+    metricas['erros'] += len(falharam)
+    for obj in objetos:
+        if obj['Key'] not in falharam:
+            metricas['excluidos'] += 1
+            metricas['bytes_liberados'] += obj.get('Size', 0)
+
+def validar_carencia(carencia_horas):
+    # Também recusa nan e inf, que passam pelo float() da rota
+    minimo = GC_CONFIG['carencia_minima_horas']
+    if not minimo <= carencia_horas < float('inf'):
+        raise ValueError(f'carencia_horas deve ser de pelo menos {minimo:g}h')
+    return carencia_horas
+
+def coletar_fotos_orfas(dry_run=True, carencia_horas=None, prefixo=None, s3_client=None):
+    # Compara as chaves do bucket com as fotos referenciadas nas tabelas de cliente
+    # e apaga as órfãs em lotes de até 1000. Retorna as métricas da execução
+    inicio = time.monotonic()
+    carencia_horas = validar_carencia(GC_CONFIG['carencia_horas'] if carencia_horas is None else carencia_horas)
+    prefixo = GC_CONFIG['prefixo'] if prefixo is None else prefixo
+    s3_client = s3_client or get_s3_client()
+    limite = datetime.now(timezone.utc) - timedelta(hours=carencia_horas)
+    
+    metricas = {
+        'dry_run': dry_run,
+        'listados': 0,
+        'referenciados': 0,
+        'em_carencia': 0,
+        'orfaos': 0,
+        'adiados': 0,
+        'excluidos': 0,
+        'erros': 0,
+        'bytes_liberados': 0
+    }
+    
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        tabelas = tabelas_com_fotos(cursor)
+        referenciadas = chaves_referenciadas(cursor, tabelas)
+        conn.commit()
+        cursor.close()
+        
+        paginator = s3_client.get_paginator('list_objects_v2')
+        lote = []
+        for pagina in paginator.paginate(Bucket=BLAZE_CONFIG['bucket_name'], Prefix=prefixo):
+            for obj in pagina.get('Contents', []):
+                metricas['listados'] += 1
+                if obj['Key'] in referenciadas:
+                    metricas['referenciados'] += 1
+                    continue
+                if obj['LastModified'] > limite:
+                    metricas['em_carencia'] += 1
+                    continue
+                
+                lote.append(obj)
+                if len(lote) >= GC_CONFIG['lote']:
+                    excluir_lote_orfaos(s3_client, conn, tabelas, lote, dry_run, metricas)
+                    lote = []
+        
+        if lote:
+            excluir_lote_orfaos(s3_client, conn, tabelas, lote, dry_run, metricas)
+    finally:
+        conn.close()
+    
+    duracao = time.monotonic() - inicio
+    metricas.update({
+        'duracao_s': round(duracao, 3),
+        'listados_por_s': round(metricas['listados'] / duracao, 1) if duracao else None,
+        'excluidos_por_s': round(metricas['excluidos'] / duracao, 1) if duracao else None
+    })
+    return metricas
+
+def executar_gc_fotos(dry_run, carencia_horas):
+    global gc_status
+    
+    try:
+        gc_status.update({'em_andamento': True, 'resultado': None, 'erro': None})
+        resultado = coletar_fotos_orfas(dry_run=dry_run, carencia_horas=carencia_horas)
+        gc_status.update({'em_andamento': False, 'resultado': resultado})
+    except Exception as e:
+        gc_status.update({'em_andamento': False, 'erro': str(e)})
+
+# Feed incremental (?since=)
+def parse_since(valor):
+    # Retorna None para o feed completo; levanta ValueError para cursor inválido
+    if valor is None or valor == '':
+        return None
+    since = int(valor)
+    if since < 0:
+        raise ValueError('since deve ser >= 0')
+    return since
+
+def cursor_alteracoes(conn):
+    cursor = conn.cursor()
+    cursor.execute(f'SELECT COALESCE(MAX(seq), 0) FROM {CLIENT_TABLE}_alteracoes')
+    ultimo = cursor.fetchone()[0]
+    cursor.close()
+    return ultimo
+
+def sql_feed(colunas, since=None, ate=None, delta=None, marcadores=('%s', '%s'), apos=None):
+    # As duas primeiras colunas são sempre (feed_id, removido); com since, traz só os
+    # veículos alterados no intervalo (since, ate] e marca como removido quem foi
+    # excluído ou desativado. `marcadores` permite gerar a versão com $1/$2 do PREPARE.
+    # `apos` retoma depois da última linha entregue (ordem estável): (created_at, id)
+    # no feed completo, (feed_id,) no incremental
+    selecao = ', '.join(f'v.{coluna}' for coluna in colunas)
+    if delta is None:
+        delta = since is not None
+    
+    if not delta:
+        retomada = 'AND (v.created_at, v.id) < (%s, %s)' if apos else ''
+        return f'''
+            SELECT v.id AS feed_id, FALSE AS removido, {selecao}
+            FROM {CLIENT_TABLE} v
+            WHERE v.ativo = TRUE {retomada}
+            ORDER BY v.created_at DESC, v.id DESC
+        ''', tuple(apos or ())
+    
+    retomada = 'WHERE m.veiculo_id > %s' if apos else ''
+    return f'''
+        WITH mudancas AS (
+            SELECT veiculo_id, MAX(seq) AS seq
+            FROM {CLIENT_TABLE}_alteracoes
+            WHERE seq > {marcadores[0]} AND seq <= {marcadores[1]}
+            GROUP BY veiculo_id
+        )
+        SELECT m.veiculo_id AS feed_id, (v.id IS NULL OR NOT v.ativo) AS removido, {selecao}
+        FROM mudancas m
+        LEFT JOIN {CLIENT_TABLE} v ON v.id = m.veiculo_id
+        {retomada}
+        ORDER BY m.veiculo_id
+    ''', (since, ate) + tuple(apos or ())
+
+# Feed XML em streaming
+# Caracteres fora do conjunto permitido pelo XML 1.0 (controles, surrogates, U+FFFE/U+FFFF);
+# um \x0b colado numa descrição quebraria o feed inteiro no parser do portal
+CARACTERES_INVALIDOS_XML = re.compile('[^\x09\x0a\x0d\x20-\ud7ff\ue000-\ufffd\U00010000-\U0010ffff]')
+
+def valor_xml(valor):
+    if isinstance(valor, (datetime, date)):
+        return valor.isoformat()
+    if isinstance(valor, bool):
+        return 'true' if valor else 'false'
+    if isinstance(valor, Decimal):
+        return f'{valor:.2f}'
+    return CARACTERES_INVALIDOS_XML.sub('', str(valor))
+
+def esvaziar_buffer(buffer):
+    conteudo = buffer.getvalue()
+    buffer.seek(0)
+    buffer.truncate(0)
+    return conteudo
+
+def gerar_xml_estoque(perfil, since=None):
+    # Escreve o XML veículo a veículo a partir de um cursor no servidor,
+    # então a memória usada não depende do tamanho do estoque.
+    # Se a réplica falhar no meio (ex.: cursor cancelado por conflito de recovery),
+    # continua no primário a partir da última linha entregue
+    config = XML_PERFIS[perfil]
+    campos = config['campos']
+    colunas = [coluna for coluna, _ in campos]
+    if config.get('fotos'):
+        colunas.append('fotos')
+    # Última coluna: chave de ordenação para a retomada
+    colunas.append('created_at')
+    
+    buffer = io.StringIO()
+    xml = XMLGenerator(buffer, encoding='utf-8', short_empty_elements=True)
+    ate = None
+    apos = None
+    cabecalho_escrito = False
+    leitura = True
+    
+    while True:
+        conn = get_db_connection(leitura=leitura)
+        try:
+            if ate is None:
+                ate = cursor_alteracoes(conn)
+            sql, params = sql_feed(colunas, since, ate, apos=apos)
+            
+            cursor = conn.cursor(name='feed_xml')
+            cursor.itersize = XML_ITERSIZE
+            cursor.execute(sql, params)
+            
+            if not cabecalho_escrito:
+                atributos = {'gerado_em': datetime.now().isoformat(), 'cursor': str(ate)}
+                if since is not None:
+                    atributos['since'] = str(since)
+                xml.startDocument()
+                xml.startElement(config['raiz'], atributos)
+                cabecalho_escrito = True
+                yield esvaziar_buffer(buffer)
+            
+            for row in cursor:
+                feed_id, removido = row[0], row[1]
+                apos = (feed_id,) if since is not None else (row[-1], feed_id)
+                
+                if removido:
+                    xml.startElement(config['removido'], {'id': str(feed_id)})
+                    xml.endElement(config['removido'])
+                    yield esvaziar_buffer(buffer)
+                    continue
+                
+                xml.startElement(config['item'], {})
+                for (_, tag), valor in zip(campos, row[2:]):
+                    if valor is None:
+                        continue
+                    xml.startElement(tag, {})
+                    xml.characters(valor_xml(valor))
+                    xml.endElement(tag)
+                
+                if config.get('fotos'):
+                    tag_grupo, tag_foto = config['fotos']
+                    xml.startElement(tag_grupo, {})
+                    for foto in row[-2] or []:
+                        xml.startElement(tag_foto, {})
+                        xml.characters(valor_xml(foto))
+                        xml.endElement(tag_foto)
+                    xml.endElement(tag_grupo)
+                
+                xml.endElement(config['item'])
+                yield esvaziar_buffer(buffer)
+            
+            xml.endElement(config['raiz'])
+            xml.endDocument()
+            yield esvaziar_buffer(buffer)
+            
+            cursor.close()
+            return
+        except ERROS_REPLICA as e:
+            if conn.replica is None:
+                print(f"Erro ao gerar feed XML ({perfil}): {e}")
+                return
+            print(f"Feed XML falhou na réplica, continuando no primário: {e}")
+            leitura = False
+        except Exception as e:
+            # Depois que o streaming começou não dá mais para trocar o status da resposta;
+            # encerra sem fechar a raiz para o portal receber um XML inválido e
+            # descartar a carga, em vez de aceitar um estoque pela metade
+            print(f"Erro ao gerar feed XML ({perfil}): {e}")
+            return
+        finally:
+            conn.close()
+
+# Normalização e gravação dos registros da FIPE
+# Campos que entram no hash: se nenhum mudar, a linha não é reescrita
+CAMPOS_HASH_FIPE = (
+    'marca_nome', 'modelo_nome', 'versao_nome', 'combustivel',
+    'motor', 'portas', 'categoria', 'cilindrada'
+)
+
+def normalizar_texto(valor):
+    if valor is None:
+        return None
+    valor = ' '.join(str(valor).split())
+    return valor or None
+
+def normalizar_registro_fipe(tipo, marca_id, marca_nome, modelo_id, modelo_nome, ano_codigo, detalhes):
+    versao_nome = normalizar_texto(detalhes.get('Modelo', modelo_nome))
+    motor = normalizar_texto(detalhes.get('SiglaCombustivel', '1.0'))
+    
+    # Extrair portas do nome do modelo
+    portas = None
+    if versao_nome:
+        match = re.search(r'(\d+)\s*Portas?', versao_nome, re.IGNORECASE)
+        if match:
+            portas = int(match.group(1))
+    
+    registro = {
+        'tipo': tipo,
+        'marca_id': int(marca_id),
+        'marca_nome': normalizar_texto(marca_nome),
+        'modelo_id': int(modelo_id),
+        'modelo_nome': normalizar_texto(modelo_nome),
+        'versao_id': str(ano_codigo),
+        'versao_nome': versao_nome,
+        'ano_modelo': int(detalhes.get('AnoModelo', 2020)),
+        'combustivel': normalizar_texto(detalhes.get('Combustivel', 'Flex')),
+        'motor': motor,
+        'portas': portas,
+        'categoria': normalizar_texto(detalhes.get('TipoVeiculo', 'Sedan')),
+        # Para motos, a cilindrada vem da sigla
+        'cilindrada': motor if tipo == 'motos' else None
+    }
+    
+    payload = json.dumps([registro[campo] for campo in CAMPOS_HASH_FIPE], ensure_ascii=False)
+    registro['hash_conteudo'] = hashlib.md5(payload.encode('utf-8')).hexdigest()
+    return registro
+
+def salvar_registro_fipe(cursor, registro):
+    # Upsert que só reescreve a linha quando o hash muda.
+    # Retorna 'inserido', 'atualizado' ou 'inalterado'
+    cursor.execute('''
+        INSERT INTO integrador (
+            tipo, marca_id, marca_nome, modelo_id, modelo_nome,
+            versao_id, versao_nome, ano_modelo, combustivel,
+            motor, portas, categoria, cilindrada, hash_conteudo
+        ) VALUES (
+            %(tipo)s, %(marca_id)s, %(marca_nome)s, %(modelo_id)s, %(modelo_nome)s,
+            %(versao_id)s, %(versao_nome)s, %(ano_modelo)s, %(combustivel)s,
+            %(motor)s, %(portas)s, %(categoria)s, %(cilindrada)s, %(hash_conteudo)s
+        )
+        ON CONFLICT (tipo, marca_id, modelo_id, versao_id, ano_modelo)
+        DO UPDATE SET
+            marca_nome = EXCLUDED.marca_nome,
+            modelo_nome = EXCLUDED.modelo_nome,
+            versao_nome = EXCLUDED.versao_nome,
+            combustivel = EXCLUDED.combustivel,
+            motor = EXCLUDED.motor,
+            portas = EXCLUDED.portas,
+            categoria = EXCLUDED.categoria,
+            cilindrada = EXCLUDED.cilindrada,
+            hash_conteudo = EXCLUDED.hash_conteudo,
+            updated_at = CURRENT_TIMESTAMP
+        WHERE integrador.hash_conteudo IS DISTINCT FROM EXCLUDED.hash_conteudo
+        RETURNING (xmax = 0) AS inserido
+    ''', registro)
+    
+    row = cursor.fetchone()
+    if row is None:
+        return 'inalterado'
+    return 'inserido' if row[0] else 'atualizado'
+
+# Atualiza as estatísticas sem bloquear as leituras do painel
+def atualizar_estatisticas(conn):
+    cursor = conn.cursor()
+    cursor.execute('REFRESH MATERIALIZED VIEW CONCURRENTLY integrador_estatisticas')
+    conn.commit()
+    cursor.close()
+
+def atualizar_estatisticas_se_mudou(conn, contagem):
+    # Roda no finally das importações, então a conexão pode ter ficado com a
+    # transação abortada ou até fechada pelo erro que interrompeu o laço
+    if contagem['inserido'] or contagem['atualizado']:
+        try:
+            conn.rollback()
+            atualizar_estatisticas(conn)
+        except Exception as e:
+            if not conn.closed:
+                conn.rollback()
+            print(f"Erro ao atualizar estatísticas: {e}")
+
+# Dead-letter dos nós da FIPE que falharam
+def criar_falha(nivel, tipo, marca_id, marca_nome, modelo_id=None, modelo_nome=None, ano_codigo=None, erro=None):
+    partes = [tipo, marca_id, modelo_id, ano_codigo]
+    return {
+        'chave': '/'.join(str(parte) for parte in partes if parte is not None),
+        'nivel': nivel,
+        'tipo': tipo,
+        'marca_id': marca_id,
+        'marca_nome': marca_nome,
+        'modelo_id': modelo_id,
+        'modelo_nome': modelo_nome,
+        'ano_codigo': ano_codigo,
+        'erro': erro
+    }
+
+def registrar_falha(cursor, falha):
+    cursor.execute('''
+        INSERT INTO integrador_falhas (
+            chave, nivel, tipo, marca_id, marca_nome, modelo_id, modelo_nome, ano_codigo, erro
+        ) VALUES (
+            %(chave)s, %(nivel)s, %(tipo)s, %(marca_id)s, %(marca_nome)s,
+            %(modelo_id)s, %(modelo_nome)s, %(ano_codigo)s, %(erro)s
+        )
+        ON CONFLICT (chave) DO UPDATE SET
+            erro = EXCLUDED.erro,
+            tentativas = integrador_falhas.tentativas + 1,
+            updated_at = CURRENT_TIMESTAMP
+    ''', falha)
+
+def coletar_modelo(tipo, marca_id, marca_nome, modelo_id, modelo_nome, limite_anos=3, anos_codigos=None):
+    # Busca anos e detalhes de um modelo. Roda nas threads do pool e não toca no banco;
+    # retorna (registros, falhas) para a thread principal gravar
+    registros = []
+    falhas = []
+    
+    if anos_codigos is None:
+        try:
+            anos = FipeAPI.get_anos(tipo, marca_id, modelo_id)
+        except FipeErro as e:
+            return [], [criar_falha('modelo', tipo, marca_id, marca_nome, modelo_id, modelo_nome, erro=str(e))]
+        anos_codigos = [ano['codigo'] for ano in anos[:limite_anos]]
+    
+    for ano_codigo in anos_codigos:
+        try:
+            detalhes = FipeAPI.get_detalhes(tipo, marca_id, modelo_id, ano_codigo)
+        except FipeErro as e:
+            falhas.append(criar_falha('ano', tipo, marca_id, marca_nome, modelo_id, modelo_nome, ano_codigo, str(e)))
+            continue
+        
+        if detalhes:
+            try:
+                registros.append(normalizar_registro_fipe(
+                    tipo, marca_id, marca_nome, modelo_id, modelo_nome, ano_codigo, detalhes
+                ))
+            except (TypeError, ValueError) as e:
+                print(f"Detalhes inválidos para {marca_nome} {modelo_nome} {ano_codigo}: {e}")
+    
+    return registros, falhas
+
+def gravar_resultado(conn, cursor, registros, falhas, contagem):
+    # Retorna True se todos os registros foram gravados
+    gravou_tudo = True
+    for registro in registros:
+        try:
+            contagem[salvar_registro_fipe(cursor, registro)] += 1
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            gravou_tudo = False
+            print(f"Erro ao inserir {registro['marca_nome']} {registro['modelo_nome']}: {e}")
+    
+    for falha in falhas:
+        registrar_falha(cursor, falha)
+        contagem['falha'] += 1
+    conn.commit()
+    return gravou_tudo
+
+def processar_modelos(executor, conn, cursor, tipo, marca_id, marca_nome, modelos, contagem,
+                      limite_anos=3, deve_parar=lambda: False):
+    futuros = [
+        executor.submit(coletar_modelo, tipo, marca_id, marca_nome, modelo['codigo'], modelo['nome'], limite_anos)
+        for modelo in modelos
+    ]
+    
+    for futuro in as_completed(futuros):
+        if deve_parar():
+            for pendente in futuros:
+                pendente.cancel()
+            break
+        registros, falhas = futuro.result()
+        gravar_resultado(conn, cursor, registros, falhas, contagem)
+
+def atualizar_contagem_status(contagem):
+    importacao_status.update({
+        'inseridos': contagem['inserido'],
+        'atualizados': contagem['atualizado'],
+        'inalterados': contagem['inalterado'],
+        'falhas': contagem['falha']
+    })
+
+def resumo_contagem(contagem):
+    return (
+        f'{contagem["inserido"]} inseridos, {contagem["atualizado"]} atualizados, '
+        f'{contagem["inalterado"]} inalterados, {contagem["falha"]} falhas'
+    )
+
+def nova_contagem():
+    return {'inserido': 0, 'atualizado': 0, 'inalterado': 0, 'falha': 0}
+
+def importacao_interrompida():
+    return not importacao_status['em_andamento']
+
 # Função que faz a importação completa da FIPE
 def importar_dados_fipe(tipo):
     global importacao_status
@@ -204,110 +1390,162 @@ def importar_dados_fipe(tipo):
             'progresso': 0,
             'total': 0,
             'atual': f'Iniciando importação de {tipo}...',
-            'erro': None
+            'erro': None,
+            'inseridos': 0,
+            'atualizados': 0,
+            'inalterados': 0,
+            'falhas': 0
         })
         
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        # 1. Buscar marcas
-        importacao_status['atual'] = f'Buscando marcas de {tipo}...'
-        marcas = FipeAPI.get_marcas(tipo)
+        with conexao() as conn:
+            cursor = conn.cursor()
+            
+            # 1. Buscar marcas
+            importacao_status['atual'] = f'Buscando marcas de {tipo}...'
+            marcas = FipeAPI.get_marcas(tipo)
+            
+            if not marcas:
+                raise Exception(f'Nenhuma marca encontrada para {tipo}')
+            
+            importacao_status['total'] = len(marcas)
+            contagem = nova_contagem()
+            
+            try:
+                with ThreadPoolExecutor(max_workers=FIPE_CONFIG['concorrencia_max']) as executor:
+                    for i, marca in enumerate(marcas):
+                        if importacao_interrompida():
+                            break
+                        
+                        marca_id = marca['codigo']
+                        marca_nome = marca['nome']
+                        
+                        importacao_status.update({
+                            'progresso': i + 1,
+                            'atual': f'Processando marca: {marca_nome}'
+                        })
+                        
+                        # 2. Buscar modelos da marca
+                        try:
+                            modelos = FipeAPI.get_modelos(tipo, marca_id)
+                        except FipeErro as e:
+                            gravar_resultado(conn, cursor, [], [criar_falha('marca', tipo, marca_id, marca_nome, erro=str(e))], contagem)
+                            atualizar_contagem_status(contagem)
+                            continue
+                        
+                        # 3 e 4. Anos e detalhes de cada modelo em paralelo (limitado a 3 anos por modelo)
+                        importacao_status['atual'] = f'Processando marca: {marca_nome} ({len(modelos)} modelos)'
+                        processar_modelos(
+                            executor, conn, cursor, tipo, marca_id, marca_nome, modelos, contagem,
+                            limite_anos=3, deve_parar=importacao_interrompida
+                        )
+                        atualizar_contagem_status(contagem)
+            finally:
+                # O que foi gravado antes de um erro ou de uma parada também
+                # tem que aparecer nas estatísticas
+                importacao_status['atual'] = 'Atualizando estatísticas...'
+                atualizar_estatisticas_se_mudou(conn, contagem)
+            
+            cursor.close()
         
-        if not marcas:
-            raise Exception(f'Nenhuma marca encontrada para {tipo}')
+        importacao_status.update({
+            'em_andamento': False,
+            'atual': f'Importação concluída! {resumo_contagem(contagem)}.',
+            'progresso': importacao_status['total']
+        })
         
-        importacao_status['total'] = len(marcas)
-        total_inseridos = 0
+    except Exception as e:
+        importacao_status.update({
+            'em_andamento': False,
+            'erro': str(e),
+            'atual': f'Erro na importação: {str(e)}'
+        })
+
+# Reprocessa só os nós que estão no dead-letter
+def reprocessar_falhas():
+    global importacao_status
+    
+    try:
+        importacao_status.update({
+            'em_andamento': True,
+            'progresso': 0,
+            'total': 0,
+            'atual': 'Carregando falhas pendentes...',
+            'erro': None,
+            'inseridos': 0,
+            'atualizados': 0,
+            'inalterados': 0,
+            'falhas': 0
+        })
         
-        for i, marca in enumerate(marcas):
-            if not importacao_status['em_andamento']:
-                break
-                
-            marca_id = marca['codigo']
-            marca_nome = marca['nome']
-            
-            importacao_status.update({
-                'progresso': i + 1,
-                'atual': f'Processando marca: {marca_nome}'
-            })
-            
-            # 2. Buscar modelos da marca
-            modelos = FipeAPI.get_modelos(tipo, marca_id)
-            
-            for modelo in modelos:
-                if not importacao_status['em_andamento']:
-                    break
-                    
-                modelo_id = modelo['codigo']
-                modelo_nome = modelo['nome']
-                
-                importacao_status['atual'] = f'Processando modelo: {marca_nome} {modelo_nome}'
-                
-                # 3. Buscar anos do modelo
-                anos = FipeAPI.get_anos(tipo, marca_id, modelo_id)
-                
-                for ano in anos[:3]:  # Limitar a 3 anos por modelo
-                    if not importacao_status['em_andamento']:
-                        break
+        with conexao() as conn:
+            cursor = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+            
+            cursor.execute('''
+                SELECT chave, nivel, tipo, marca_id, marca_nome, modelo_id, modelo_nome, ano_codigo
+                FROM integrador_falhas
+                ORDER BY id
+            ''')
+            falhas = cursor.fetchall()
+            
+            importacao_status['total'] = len(falhas)
+            contagem = nova_contagem()
+            
+            try:
+                with ThreadPoolExecutor(max_workers=FIPE_CONFIG['concorrencia_max']) as executor:
+                    for i, falha in enumerate(falhas):
+                        if importacao_interrompida():
+                            break
                         
-                    ano_codigo = ano['codigo']
-                    
-                    # 4. Buscar detalhes
-                    detalhes = FipeAPI.get_detalhes(tipo, marca_id, modelo_id, ano_codigo)
-                    
-                    if detalhes:
-                        try:
-                            ano_modelo = detalhes.get('AnoModelo', 2020)
-                            combustivel = detalhes.get('Combustivel', 'Flex')
-                            motor = detalhes.get('SiglaCombustivel', '1.0')
-                            versao_nome = detalhes.get('Modelo', modelo_nome)
-                            categoria = detalhes.get('TipoVeiculo', 'Sedan')
-                            
-                            # Extrair portas do nome do modelo
-                            portas = None
-                            if 'Portas' in versao_nome:
-                                import re
-                                match = re.search(r'(\d+)\s*Portas?', versao_nome, re.IGNORECASE)
-                                if match:
-                                    portas = int(match.group(1))
-                            
-                            # Para motos, extrair cilindrada
-                            cilindrada = None
-                            if tipo == 'motos':
-                                cilindrada = motor
-                            
-                            # Inserir no banco
-                            cursor.execute('''
-                                INSERT INTO integrador (
-                                    tipo, marca_id, marca_nome, modelo_id, modelo_nome,
-                                    versao_id, versao_nome, ano_modelo, combustivel, 
-                                    motor, portas, categoria, cilindrada
-                                ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                                ON CONFLICT (tipo, marca_id, modelo_id, versao_id, ano_modelo) 
-                                DO NOTHING
-                            ''', (
-                                tipo, marca_id, marca_nome, modelo_id, modelo_nome,
-                                ano_codigo, versao_nome, ano_modelo, combustivel,
-                                motor, portas, categoria, cilindrada
-                            ))
-                            
-                            if cursor.rowcount > 0:
-                                total_inseridos += 1
-                                
-                            conn.commit()
-                            time.sleep(0.1)
+                        importacao_status.update({
+                            'progresso': i + 1,
+                            'atual': f'Reprocessando {falha["chave"]}'
+                        })
+                        
+                        tipo = falha['tipo']
+                        marca_id = falha['marca_id']
+                        marca_nome = falha['marca_nome']
+                        
+                        if falha['nivel'] == 'marca':
+                            try:
+                                modelos = FipeAPI.get_modelos(tipo, marca_id)
+                            except FipeErro as e:
+                                gravar_resultado(conn, cursor, [], [criar_falha('marca', tipo, marca_id, marca_nome, erro=str(e))], contagem)
+                                continue
                             
-                        except Exception as e:
-                            print(f"Erro ao inserir {marca_nome} {modelo_nome}: {e}")
-                            continue
-        
-        cursor.close()
-        conn.close()
+                            # Os modelos que falharem agora ganham entradas próprias
+                            processar_modelos(
+                                executor, conn, cursor, tipo, marca_id, marca_nome, modelos, contagem,
+                                limite_anos=3, deve_parar=importacao_interrompida
+                            )
+                            if not importacao_interrompida():
+                                cursor.execute('DELETE FROM integrador_falhas WHERE chave = %s', (falha['chave'],))
+                                conn.commit()
+                        else:
+                            anos_codigos = [falha['ano_codigo']] if falha['nivel'] == 'ano' else None
+                            registros, novas_falhas = coletar_modelo(
+                                tipo, marca_id, marca_nome, falha['modelo_id'], falha['modelo_nome'],
+                                anos_codigos=anos_codigos
+                            )
+                            # Se o mesmo nó falhar de novo, o upsert atualiza a linha existente
+                            # (mantém o id e soma a tentativa); só sai da fila quando deu certo
+                            gravou_tudo = gravar_resultado(conn, cursor, registros, novas_falhas, contagem)
+                            falhou_de_novo = any(nova['chave'] == falha['chave'] for nova in novas_falhas)
+                            if gravou_tudo and not falhou_de_novo:
+                                cursor.execute('DELETE FROM integrador_falhas WHERE chave = %s', (falha['chave'],))
+                                conn.commit()
+                        
+                        atualizar_contagem_status(contagem)
+            finally:
+                # O que foi gravado antes de um erro ou de uma parada também
+                # tem que aparecer nas estatísticas
+                importacao_status['atual'] = 'Atualizando estatísticas...'
+                atualizar_estatisticas_se_mudou(conn, contagem)
+            
+            cursor.close()
         
         importacao_status.update({
             'em_andamento': False,
-            'atual': f'Importação concluída! {total_inseridos} registros inseridos.',
+            'atual': f'Reprocessamento concluído! {resumo_contagem(contagem)}.',
             'progresso': importacao_status['total']
         })
         
@@ -315,9 +1553,135 @@ def importar_dados_fipe(tipo):
         importacao_status.update({
             'em_andamento': False,
             'erro': str(e),
-            'atual': f'Erro na importação: {str(e)}'
+            'atual': f'Erro no reprocessamento: {str(e)}'
         })
 
+# Camada de acesso a dados das rotas quentes (painel, feed JSON e cascata da FIPE):
+# consultas como prepared statements por conexão (as conexões vêm do pool), só as
+# colunas necessárias e linhas mapeadas em namedtuples em vez de um dict por linha
+VeiculoResumo = namedtuple('VeiculoResumo', [
+    'id', 'tipo', 'marca_nome', 'modelo_nome', 'versao_nome', 'ano_modelo', 'ano_fabricacao',
+    'km', 'cor', 'combustivel', 'preco', 'fotos', 'ativo'
+])
+
+Veiculo = namedtuple('Veiculo', [
+    'id', 'tipo', 'marca_id', 'marca_nome', 'modelo_id', 'modelo_nome', 'versao_id', 'versao_nome',
+    'ano_modelo', 'ano_fabricacao', 'km', 'cor', 'combustivel', 'cambio', 'motor', 'portas',
+    'categoria', 'cilindrada', 'preco', 'fotos', 'ativo', 'created_at', 'updated_at'
+])
+
+DetalheFipe = namedtuple('DetalheFipe', [
+    'ano_modelo', 'combustivel', 'motor', 'modelo_nome', 'versao_nome', 'categoria'
+])
+
+def colunas(tipo_linha, prefixo=''):
+    return ', '.join(prefixo + campo for campo in tipo_linha._fields)
+
+CONSULTAS_PREPARADAS = {
+    'veiculos_painel': ('', f'''
+        SELECT {colunas(VeiculoResumo)} FROM {CLIENT_TABLE} ORDER BY created_at DESC
+    '''),
+    'veiculo_por_id': ('integer', f'''
+        SELECT {colunas(Veiculo)} FROM {CLIENT_TABLE} WHERE id = $1
+    '''),
+    'ultima_alteracao': ('', f'''
+        SELECT COALESCE(MAX(seq), 0) FROM {CLIENT_TABLE}_alteracoes
+    '''),
+    'feed_completo': ('', sql_feed(Veiculo._fields, delta=False)[0]),
+    'feed_delta': ('bigint, bigint', sql_feed(Veiculo._fields, delta=True, marcadores=('$1', '$2'))[0]),
+    'marcas_por_tipo': ('varchar', '''
+        SELECT DISTINCT marca_id, marca_nome
+        FROM integrador
+        WHERE tipo = $1 AND marca_id IS NOT NULL AND marca_nome IS NOT NULL
+        ORDER BY marca_nome
+    '''),
+    'modelos_por_marca': ('varchar, integer', '''
+        SELECT DISTINCT modelo_id, modelo_nome
+        FROM integrador
+        WHERE tipo = $1 AND marca_id = $2 AND modelo_id IS NOT NULL AND modelo_nome IS NOT NULL
+        ORDER BY modelo_nome
+    '''),
+    'anos_por_modelo': ('varchar, integer, integer', '''
+        SELECT DISTINCT ano_modelo, versao_nome, versao_id
+        FROM integrador
+        WHERE tipo = $1 AND marca_id = $2 AND modelo_id = $3 AND ano_modelo IS NOT NULL
+        ORDER BY ano_modelo DESC, versao_nome
+    '''),
+    'detalhes_por_ano': ('varchar, integer, integer, integer', f'''
+        SELECT {colunas(DetalheFipe)}
+        FROM integrador
+        WHERE tipo = $1 AND marca_id = $2 AND modelo_id = $3 AND ano_modelo = $4
+        ORDER BY created_at DESC LIMIT 1
+    ''')
+}
+
+def executar_preparada(conn, nome, params=()):
+    # Faz o PREPARE na primeira vez que a conexão usa a consulta; depois só EXECUTE
+    cursor = conn.cursor()
+    if nome not in conn.preparados:
+        tipos, consulta = CONSULTAS_PREPARADAS[nome]
+        assinatura = f' ({tipos})' if tipos else ''
+        cursor.execute(f'PREPARE {nome}{assinatura} AS {consulta}')
+        conn.preparados.add(nome)
+    
+    execucao = f'EXECUTE {nome} ({", ".join(["%s"] * len(params))})' if params else f'EXECUTE {nome}'
+    try:
+        cursor.execute(execucao, params)
+    except psycopg2.errors.InvalidSqlStatementName:
+        # O servidor perdeu o statement (ex.: DISCARD ALL de um pooler): prepara de novo
+        conn.rollback()
+        conn.preparados.discard(nome)
+        cursor.close()
+        return executar_preparada(conn, nome, params)
+    
+    rows = cursor.fetchall()
+    cursor.close()
+    return rows
+
+class RepositorioVeiculos:
+    @staticmethod
+    def listar_painel():
+        return executar_leitura(
+            lambda conn: list(map(VeiculoResumo._make, executar_preparada(conn, 'veiculos_painel')))
+        )
+    
+    @staticmethod
+    def buscar(veiculo_id):
+        rows = executar_leitura(lambda conn: executar_preparada(conn, 'veiculo_por_id', (veiculo_id,)))
+        return Veiculo._make(rows[0]) if rows else None
+    
+    @staticmethod
+    def feed(since=None):
+        # Retorna (cursor, linhas); cada linha é (feed_id, removido, *Veiculo)
+        def consultar(conn):
+            ate = executar_preparada(conn, 'ultima_alteracao')[0][0]
+            if since is None:
+                return ate, executar_preparada(conn, 'feed_completo')
+            return ate, executar_preparada(conn, 'feed_delta', (since, ate))
+        return executar_leitura(consultar)
+
+class RepositorioCatalogo:
+    @staticmethod
+    def marcas(tipo):
+        return executar_leitura(lambda conn: executar_preparada(conn, 'marcas_por_tipo', (tipo,)))
+    
+    @staticmethod
+    def modelos(tipo, marca_id):
+        return executar_leitura(lambda conn: executar_preparada(conn, 'modelos_por_marca', (tipo, marca_id)))
+    
+    @staticmethod
+    def anos(tipo, marca_id, modelo_id):
+        return executar_leitura(
+            lambda conn: executar_preparada(conn, 'anos_por_modelo', (tipo, marca_id, modelo_id))
+        )
+    
+    @staticmethod
+    def detalhes(tipo, marca_id, modelo_id, ano_modelo):
+        rows = executar_leitura(
+            lambda conn: executar_preparada(conn, 'detalhes_por_ano', (tipo, marca_id, modelo_id, ano_modelo))
+        )
+        return DetalheFipe._make(rows[0]) if rows else None
+
 # Rotas principais
 @app.route('/')
 def index():
@@ -348,15 +1712,7 @@ def logout():
 @login_required
 def dashboard():
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-        
-        cursor.execute(f'SELECT * FROM {CLIENT_TABLE} ORDER BY created_at DESC')
-        veiculos = cursor.fetchall()
-        
-        cursor.close()
-        conn.close()
-        
+        veiculos = RepositorioVeiculos.listar_painel()
         return render_template('dashboard.html', veiculos=veiculos, client_table=CLIENT_TABLE)
     except Exception as e:
         flash(f'Erro ao carregar dashboard: {e}', 'error')
@@ -371,14 +1727,7 @@ def novo_veiculo():
 @login_required
 def editar_veiculo(veiculo_id):
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-        
-        cursor.execute(f'SELECT * FROM {CLIENT_TABLE} WHERE id = %s', (veiculo_id,))
-        veiculo = cursor.fetchone()
-        
-        cursor.close()
-        conn.close()
+        veiculo = RepositorioVeiculos.buscar(veiculo_id)
         
         if not veiculo:
             flash('Veículo não encontrado', 'error')
@@ -396,16 +1745,17 @@ def salvar_veiculo():
         data = request.form.to_dict()
         veiculo_id = data.get('id')
         
-        # Upload de fotos
+        # Upload de fotos antes de abrir a transação de escrita
         fotos = []
+        enviadas = {}
         if 'fotos' in request.files:
             files = request.files.getlist('fotos')
             for file in files:
                 if file.filename:
-                    filename = f"{uuid.uuid4()}_{secure_filename(file.filename)}"
-                    url = upload_to_blaze(file, filename)
+                    url = upload_to_blaze(file, file.filename)
                     if url:
                         fotos.append(url)
+                        enviadas.setdefault(url, file)
         
         # Manter fotos existentes se estiver editando
         if veiculo_id and 'fotos_existentes' in data:
@@ -415,40 +1765,51 @@ def salvar_veiculo():
             except:
                 pass
         
-        conn = get_db_connection()
-        cursor = conn.cursor()
+        # A mesma foto enviada duas vezes vira uma única URL
+        fotos = list(dict.fromkeys(fotos))
         
-        if veiculo_id:  # Editar
-            cursor.execute(f'''
-                UPDATE {CLIENT_TABLE} SET
-                tipo = %s, marca_id = %s, marca_nome = %s, modelo_id = %s, modelo_nome = %s,
-                versao_id = %s, versao_nome = %s, ano_modelo = %s, ano_fabricacao = %s,
-                km = %s, cor = %s, combustivel = %s, cambio = %s, motor = %s, portas = %s,
-                categoria = %s, cilindrada = %s, preco = %s, fotos = %s, updated_at = CURRENT_TIMESTAMP
-                WHERE id = %s
-            ''', (
-                data['tipo'], data['marca_id'], data['marca_nome'], data['modelo_id'], data['modelo_nome'],
-                data['versao_id'], data['versao_nome'], data['ano_modelo'], data['ano_fabricacao'],
-                data['km'], data['cor'], data['combustivel'], data['cambio'], data['motor'], data['portas'],
-                data['categoria'], data.get('cilindrada'), data['preco'], fotos, veiculo_id
-            ))
-        else:  # Criar
-            cursor.execute(f'''
-                INSERT INTO {CLIENT_TABLE} (
-                    tipo, marca_id, marca_nome, modelo_id, modelo_nome, versao_id, versao_nome,
-                    ano_modelo, ano_fabricacao, km, cor, combustivel, cambio, motor, portas,
-                    categoria, cilindrada, preco, fotos
-                ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-            ''', (
-                data['tipo'], data['marca_id'], data['marca_nome'], data['modelo_id'], data['modelo_nome'],
-                data['versao_id'], data['versao_nome'], data['ano_modelo'], data['ano_fabricacao'],
-                data['km'], data['cor'], data['combustivel'], data['cambio'], data['motor'], data['portas'],
-                data['categoria'], data.get('cilindrada'), data['preco'], fotos
-            ))
-        
-        conn.commit()
-        cursor.close()
-        conn.close()
+        with conexao() as conn:
+            cursor = conn.cursor()
+            
+            # Impede que um lote do GC apague uma destas fotos antes do commit
+            travar_fotos(cursor)
+            garantir_fotos_enviadas(cursor, enviadas)
+            
+            if veiculo_id:  # Editar
+                cursor.execute(f'''
+                    UPDATE {CLIENT_TABLE} SET
+                    tipo = %s, marca_id = %s, marca_nome = %s, modelo_id = %s, modelo_nome = %s,
+                    versao_id = %s, versao_nome = %s, ano_modelo = %s, ano_fabricacao = %s,
+                    km = %s, cor = %s, combustivel = %s, cambio = %s, motor = %s, portas = %s,
+                    categoria = %s, cilindrada = %s, preco = %s, fotos = %s, updated_at = CURRENT_TIMESTAMP
+                    WHERE id = %s
+                ''', (
+                    data['tipo'], data['marca_id'], data['marca_nome'], data['modelo_id'], data['modelo_nome'],
+                    data['versao_id'], data['versao_nome'], data['ano_modelo'], data['ano_fabricacao'],
+                    data['km'], data['cor'], data['combustivel'], data['cambio'], data['motor'], data['portas'],
+                    data['categoria'], data.get('cilindrada'), data['preco'], fotos, veiculo_id
+                ))
+            else:  # Criar
+                cursor.execute(f'''
+                    INSERT INTO {CLIENT_TABLE} (
+                        tipo, marca_id, marca_nome, modelo_id, modelo_nome, versao_id, versao_nome,
+                        ano_modelo, ano_fabricacao, km, cor, combustivel, cambio, motor, portas,
+                        categoria, cilindrada, preco, fotos
+                    ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+                    RETURNING id
+                ''', (
+                    data['tipo'], data['marca_id'], data['marca_nome'], data['modelo_id'], data['modelo_nome'],
+                    data['versao_id'], data['versao_nome'], data['ano_modelo'], data['ano_fabricacao'],
+                    data['km'], data['cor'], data['combustivel'], data['cambio'], data['motor'], data['portas'],
+                    data['categoria'], data.get('cilindrada'), data['preco'], fotos
+                ))
+                veiculo_id = cursor.fetchone()[0]
+            
+            sincronizar_referencias_fotos(cursor, veiculo_id, fotos)
+            
+            conn.commit()
+            registrar_escrita(conn)
+            cursor.close()
         
         flash('Veículo salvo com sucesso!', 'success')
         return redirect(url_for('dashboard'))
@@ -461,14 +1822,14 @@ def salvar_veiculo():
 @login_required
 def excluir_veiculo(veiculo_id):
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute(f'DELETE FROM {CLIENT_TABLE} WHERE id = %s', (veiculo_id,))
-        
-        conn.commit()
-        cursor.close()
-        conn.close()
+        with conexao() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute(f'DELETE FROM {CLIENT_TABLE} WHERE id = %s', (veiculo_id,))
+            
+            conn.commit()
+            registrar_escrita(conn)
+            cursor.close()
         
         flash('Veículo excluído com sucesso!', 'success')
     except Exception as e:
@@ -480,14 +1841,14 @@ def excluir_veiculo(veiculo_id):
 @login_required
 def toggle_veiculo(veiculo_id):
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute(f'UPDATE {CLIENT_TABLE} SET ativo = NOT ativo WHERE id = %s', (veiculo_id,))
-        
-        conn.commit()
-        cursor.close()
-        conn.close()
+        with conexao() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute(f'UPDATE {CLIENT_TABLE} SET ativo = NOT ativo WHERE id = %s', (veiculo_id,))
+            
+            conn.commit()
+            registrar_escrita(conn)
+            cursor.close()
         
         return jsonify({'success': True})
     except Exception as e:
@@ -522,7 +1883,93 @@ def iniciar_importacao_fipe(tipo):
 @app.route('/admin/status-importacao')
 @login_required
 def status_importacao():
-    return jsonify(importacao_status)
+    return jsonify(dict(importacao_status, api=FipeAPI.controle.estado()))
+
+@app.route('/admin/reprocessar-falhas')
+@login_required
+def iniciar_reprocessamento():
+    global importacao_status
+    
+    if importacao_status['em_andamento']:
+        return jsonify({
+            'success': False,
+            'message': 'Já existe uma importação em andamento'
+        })
+    
+    thread = threading.Thread(target=reprocessar_falhas)
+    thread.daemon = True
+    thread.start()
+    
+    return jsonify({
+        'success': True,
+        'message': 'Reprocessamento das falhas iniciado em background'
+    })
+
+@app.route('/admin/falhas')
+@login_required
+def listar_falhas():
+    def consultar(conn):
+        cursor = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+        
+        cursor.execute('SELECT COUNT(*) AS total FROM integrador_falhas')
+        total = cursor.fetchone()['total']
+        
+        cursor.execute('''
+            SELECT chave, nivel, marca_nome, modelo_nome, ano_codigo, erro, tentativas, updated_at
+            FROM integrador_falhas
+            ORDER BY updated_at DESC
+            LIMIT 50
+        ''')
+        falhas = cursor.fetchall()
+        
+        cursor.close()
+        return total, falhas
+    
+    try:
+        total, falhas = executar_leitura(consultar)
+        
+        for falha in falhas:
+            falha['updated_at'] = falha['updated_at'].isoformat()
+        
+        return jsonify({'total': total, 'falhas': falhas})
+        
+    except Exception as e:
+        return jsonify({'total': 0, 'falhas': [], 'error': str(e)})
+
+@app.route('/admin/gc-fotos')
+@login_required
+def iniciar_gc_fotos():
+    global gc_status
+    
+    if gc_status['em_andamento']:
+        return jsonify({
+            'success': False,
+            'message': 'Já existe uma coleta de fotos em andamento'
+        })
+    
+    # Por padrão só simula; ?executar=1 apaga de verdade
+    dry_run = request.args.get('executar') != '1'
+    try:
+        carencia_horas = validar_carencia(float(request.args.get('carencia_horas', GC_CONFIG['carencia_horas'])))
+    except ValueError:
+        return jsonify({
+            'success': False,
+            'message': f"carencia_horas inválida (mínimo de {GC_CONFIG['carencia_minima_horas']:g}h)"
+        }), 400
+    
+    thread = threading.Thread(target=executar_gc_fotos, args=(dry_run, carencia_horas))
+    thread.daemon = True
+    thread.start()
+    
+    return jsonify({
+        'success': True,
+        'message': f'Coleta de fotos órfãs iniciada em background ({"simulação" if dry_run else "exclusão"})'
+    })
+
+@app.route('/admin/status-gc-fotos')
+@login_required
+def status_gc_fotos():
+    return jsonify(gc_status)
 
 @app.route('/admin/parar-importacao')
 @login_required
@@ -535,81 +1982,59 @@ def parar_importacao():
 @login_required
 def importacao_rapida():
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        marcas_populares = {
-            'carros': [
-                {'codigo': 59, 'nome': 'Volkswagen'},
-                {'codigo': 22, 'nome': 'Chevrolet'}, 
-                {'codigo': 26, 'nome': 'Ford'},
-                {'codigo': 25, 'nome': 'Fiat'},
-                {'codigo': 21, 'nome': 'Hyundai'},
-                {'codigo': 320, 'nome': 'Toyota'}
-            ],
-            'motos': [
-                {'codigo': 26, 'nome': 'Honda'},
-                {'codigo': 52, 'nome': 'Yamaha'},
-                {'codigo': 46, 'nome': 'Suzuki'},
-                {'codigo': 28, 'nome': 'Kawasaki'}
-            ]
-        }
-        
-        total_inseridos = 0
-        
-        for tipo, marcas in marcas_populares.items():
-            for marca in marcas:
-                marca_id = marca['codigo']
-                marca_nome = marca['nome']
-                
-                modelos = FipeAPI.get_modelos(tipo, marca_id)
-                
-                for modelo in modelos[:5]:
-                    modelo_id = modelo['codigo']
-                    modelo_nome = modelo['nome']
-                    
-                    anos = FipeAPI.get_anos(tipo, marca_id, modelo_id)
-                    
-                    for ano in anos[:2]:
-                        ano_codigo = ano['codigo']
-                        
-                        detalhes = FipeAPI.get_detalhes(tipo, marca_id, modelo_id, ano_codigo)
-                        
-                        if detalhes:
+        with conexao() as conn:
+            cursor = conn.cursor()
+            
+            marcas_populares = {
+                'carros': [
+                    {'codigo': 59, 'nome': 'Volkswagen'},
+                    {'codigo': 22, 'nome': 'Chevrolet'}, 
+                    {'codigo': 26, 'nome': 'Ford'},
+                    {'codigo': 25, 'nome': 'Fiat'},
+                    {'codigo': 21, 'nome': 'Hyundai'},
+                    {'codigo': 320, 'nome': 'Toyota'}
+                ],
+                'motos': [
+                    {'codigo': 26, 'nome': 'Honda'},
+                    {'codigo': 52, 'nome': 'Yamaha'},
+                    {'codigo': 46, 'nome': 'Suzuki'},
+                    {'codigo': 28, 'nome': 'Kawasaki'}
+                ]
+            }
+            
+            contagem = nova_contagem()
+            
+            try:
+                with ThreadPoolExecutor(max_workers=FIPE_CONFIG['concorrencia_max']) as executor:
+                    for tipo, marcas in marcas_populares.items():
+                        for marca in marcas:
+                            marca_id = marca['codigo']
+                            marca_nome = marca['nome']
+                            
                             try:
-                                cursor.execute('''
-                                    INSERT INTO integrador (
-                                        tipo, marca_id, marca_nome, modelo_id, modelo_nome,
-                                        versao_id, versao_nome, ano_modelo, combustivel, 
-                                        motor, categoria
-                                    ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                                    ON CONFLICT (tipo, marca_id, modelo_id, versao_id, ano_modelo) 
-                                    DO NOTHING
-                                ''', (
-                                    tipo, marca_id, marca_nome, modelo_id, modelo_nome,
-                                    ano_codigo, detalhes.get('Modelo', modelo_nome), 
-                                    detalhes.get('AnoModelo', 2020),
-                                    detalhes.get('Combustivel', 'Flex'),
-                                    detalhes.get('SiglaCombustivel', '1.0'),
-                                    detalhes.get('TipoVeiculo', 'Sedan')
-                                ))
-                                
-                                if cursor.rowcount > 0:
-                                    total_inseridos += 1
-                                    
-                                conn.commit()
-                                time.sleep(0.05)
-                                
-                            except Exception as e:
+                                modelos = FipeAPI.get_modelos(tipo, marca_id)
+                            except FipeErro as e:
+                                gravar_resultado(conn, cursor, [], [criar_falha('marca', tipo, marca_id, marca_nome, erro=str(e))], contagem)
                                 continue
-        
-        cursor.close()
-        conn.close()
+                            
+                            processar_modelos(
+                                executor, conn, cursor, tipo, marca_id, marca_nome, modelos[:5], contagem,
+                                limite_anos=2
+                            )
+            finally:
+                # O que foi gravado antes de um erro ou de uma parada também
+                # tem que aparecer nas estatísticas
+                atualizar_estatisticas_se_mudou(conn, contagem)
+            
+            cursor.close()
         
         return jsonify({
             'success': True,
-            'message': f'Importação rápida concluída! {total_inseridos} registros inseridos.',
-            'total_inseridos': total_inseridos
+            'message': f'Importação rápida concluída! {resumo_contagem(contagem)}.',
+            'total_inseridos': contagem['inserido'],
+            'total_atualizados': contagem['atualizado'],
+            'total_inalterados': contagem['inalterado'],
+            'total_falhas': contagem['falha']
         })
         
     except Exception as e:
@@ -621,28 +2046,43 @@ def importacao_rapida():
 @app.route('/admin/verificar-dados')
 @login_required
 def verificar_dados():
-    try:
-        conn = get_db_connection()
+    # Lê da view materializada integrador_estatisticas (uma linha por tipo/marca/ano),
+    # nunca da tabela inteira
+    def consultar(conn):
         cursor = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
         
-        cursor.execute('SELECT COUNT(*) as total FROM integrador')
-        total = cursor.fetchone()['total']
-        
         cursor.execute('''
-            SELECT tipo, COUNT(*) as quantidade 
-            FROM integrador 
+            SELECT tipo, SUM(quantidade)::bigint AS quantidade
+            FROM integrador_estatisticas
             GROUP BY tipo
         ''')
         por_tipo = cursor.fetchall()
         
         cursor.execute('''
-            SELECT tipo, COUNT(DISTINCT marca_id) as marcas 
-            FROM integrador 
-            WHERE marca_id IS NOT NULL
+            SELECT tipo, COUNT(DISTINCT marca_id) AS marcas
+            FROM integrador_estatisticas
+            WHERE marca_id <> 0
             GROUP BY tipo
         ''')
         marcas_por_tipo = cursor.fetchall()
         
+        cursor.execute('''
+            SELECT tipo, marca_id, MAX(marca_nome) AS marca_nome, SUM(quantidade)::bigint AS quantidade
+            FROM integrador_estatisticas
+            GROUP BY tipo, marca_id
+            ORDER BY quantidade DESC
+        ''')
+        por_marca = cursor.fetchall()
+        
+        cursor.execute('''
+            SELECT tipo, ano_modelo, SUM(quantidade)::bigint AS quantidade
+            FROM integrador_estatisticas
+            GROUP BY tipo, ano_modelo
+            ORDER BY tipo, ano_modelo DESC
+        ''')
+        por_ano = cursor.fetchall()
+        
+        # Usa o índice em created_at
         cursor.execute('''
             SELECT marca_nome, modelo_nome, ano_modelo, tipo 
             FROM integrador 
@@ -652,12 +2092,17 @@ def verificar_dados():
         amostra = cursor.fetchall()
         
         cursor.close()
-        conn.close()
+        return por_tipo, marcas_por_tipo, por_marca, por_ano, amostra
+    
+    try:
+        por_tipo, marcas_por_tipo, por_marca, por_ano, amostra = executar_leitura(consultar)
         
         return jsonify({
-            'total_registros': total,
+            'total_registros': sum(row['quantidade'] for row in por_tipo),
             'por_tipo': [dict(row) for row in por_tipo],
             'marcas_por_tipo': [dict(row) for row in marcas_por_tipo],
+            'por_marca': [dict(row) for row in por_marca],
+            'por_ano': [dict(row) for row in por_ano],
             'amostra': [dict(row) for row in amostra]
         })
         
@@ -666,6 +2111,8 @@ def verificar_dados():
             'total_registros': 0,
             'por_tipo': [],
             'marcas_por_tipo': [],
+            'por_marca': [],
+            'por_ano': [],
             'amostra': [],
             'error': str(e)
         })
@@ -675,23 +2122,7 @@ def verificar_dados():
 @login_required
 def api_marcas(tipo):
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-        
-        cursor.execute('''
-            SELECT DISTINCT marca_id as codigo, marca_nome as nome 
-            FROM integrador 
-            WHERE tipo = %s 
-            AND marca_id IS NOT NULL 
-            AND marca_nome IS NOT NULL 
-            ORDER BY marca_nome
-        ''', (tipo,))
-        
-        marcas = [{'codigo': m['codigo'], 'nome': m['nome']} for m in cursor.fetchall()]
-        
-        cursor.close()
-        conn.close()
-        
+        marcas = [{'codigo': codigo, 'nome': nome} for codigo, nome in RepositorioCatalogo.marcas(tipo)]
         return jsonify(marcas)
         
     except Exception as e:
@@ -702,23 +2133,10 @@ def api_marcas(tipo):
 @login_required
 def api_modelos(tipo, marca_id):
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-        
-        cursor.execute('''
-            SELECT DISTINCT modelo_id as codigo, modelo_nome as nome 
-            FROM integrador 
-            WHERE tipo = %s AND marca_id = %s 
-            AND modelo_id IS NOT NULL 
-            AND modelo_nome IS NOT NULL 
-            ORDER BY modelo_nome
-        ''', (tipo, int(marca_id)))
-        
-        modelos = [{'codigo': m['codigo'], 'nome': m['nome']} for m in cursor.fetchall()]
-        
-        cursor.close()
-        conn.close()
-        
+        modelos = [
+            {'codigo': codigo, 'nome': nome}
+            for codigo, nome in RepositorioCatalogo.modelos(tipo, int(marca_id))
+        ]
         return jsonify(modelos)
         
     except Exception as e:
@@ -729,26 +2147,12 @@ def api_modelos(tipo, marca_id):
 @login_required
 def api_anos(tipo, marca_id, modelo_id):
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-        
-        cursor.execute('''
-            SELECT DISTINCT ano_modelo, versao_nome, versao_id
-            FROM integrador 
-            WHERE tipo = %s AND marca_id = %s AND modelo_id = %s 
-            AND ano_modelo IS NOT NULL
-            ORDER BY ano_modelo DESC, versao_nome
-        ''', (tipo, int(marca_id), int(modelo_id)))
-        
         anos = []
-        for row in cursor.fetchall():
-            codigo = f"{row['ano_modelo']}-{row['versao_id']}" if row['versao_id'] else str(row['ano_modelo'])
-            nome = f"{row['ano_modelo']} - {row['versao_nome']}"
+        for ano_modelo, versao_nome, versao_id in RepositorioCatalogo.anos(tipo, int(marca_id), int(modelo_id)):
+            codigo = f"{ano_modelo}-{versao_id}" if versao_id else str(ano_modelo)
+            nome = f"{ano_modelo} - {versao_nome}"
             anos.append({'codigo': codigo, 'nome': nome})
         
-        cursor.close()
-        conn.close()
-        
         return jsonify(anos)
         
     except Exception as e:
@@ -764,24 +2168,15 @@ def api_detalhes(tipo, marca_id, modelo_id, ano_codigo):
         else:
             ano_modelo = int(ano_codigo)
         
-        conn = get_db_connection()
-        cursor = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-        
-        cursor.execute('''
-            SELECT * FROM integrador 
-            WHERE tipo = %s AND marca_id = %s AND modelo_id = %s AND ano_modelo = %s
-            ORDER BY created_at DESC LIMIT 1
-        ''', (tipo, int(marca_id), int(modelo_id), ano_modelo))
-        
-        row = cursor.fetchone()
+        row = RepositorioCatalogo.detalhes(tipo, int(marca_id), int(modelo_id), ano_modelo)
         
         if row:
             detalhes = {
-                'AnoModelo': row['ano_modelo'],
-                'Combustivel': row['combustivel'] or 'Flex',
-                'SiglaCombustivel': row['motor'] or '1.0',
-                'Modelo': row['versao_nome'] or row['modelo_nome'],
-                'TipoVeiculo': row['categoria'] or 'Sedan'
+                'AnoModelo': row.ano_modelo,
+                'Combustivel': row.combustivel or 'Flex',
+                'SiglaCombustivel': row.motor or '1.0',
+                'Modelo': row.versao_nome or row.modelo_nome,
+                'TipoVeiculo': row.categoria or 'Sedan'
             }
         else:
             detalhes = {
@@ -792,9 +2187,6 @@ def api_detalhes(tipo, marca_id, modelo_id, ano_codigo):
                 'TipoVeiculo': 'Sedan'
             }
         
-        cursor.close()
-        conn.close()
-        
         return jsonify(detalhes)
         
     except Exception as e:
@@ -809,30 +2201,55 @@ def api_detalhes(tipo, marca_id, modelo_id, ano_codigo):
 
 @app.route('/xml')
 def xml_endpoint():
+    perfil = request.args.get('formato', 'generico')
+    if perfil not in XML_PERFIS:
+        return Response(
+            f'<erro>Formato desconhecido: {escape(perfil)}. Use um de: {", ".join(XML_PERFIS)}</erro>',
+            status=400,
+            mimetype='application/xml'
+        )
+    
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-        
-        cursor.execute(f'SELECT * FROM {CLIENT_TABLE} WHERE ativo = TRUE ORDER BY created_at DESC')
-        veiculos = cursor.fetchall()
-        
-        cursor.close()
-        conn.close()
+        since = parse_since(request.args.get('since'))
+    except ValueError:
+        return Response('<erro>Parâmetro since inválido</erro>', status=400, mimetype='application/xml')
+    
+    return Response(stream_with_context(gerar_xml_estoque(perfil, since)), mimetype='application/xml')
+
+@app.route('/json')
+def json_endpoint():
+    try:
+        since = parse_since(request.args.get('since'))
+    except ValueError:
+        return jsonify({'error': 'Parâmetro since inválido'}), 400
+    
+    try:
+        ate, veiculos = RepositorioVeiculos.feed(since)
         
         veiculos_json = []
-        for veiculo in veiculos:
-            veiculo_dict = dict(veiculo)
+        removidos = []
+        for feed_id, removido, *valores in veiculos:
+            if removido:
+                removidos.append(feed_id)
+                continue
+            veiculo_dict = dict(zip(Veiculo._fields, valores))
             if veiculo_dict.get('created_at'):
                 veiculo_dict['created_at'] = veiculo_dict['created_at'].isoformat()
             if veiculo_dict.get('updated_at'):
                 veiculo_dict['updated_at'] = veiculo_dict['updated_at'].isoformat()
             veiculos_json.append(veiculo_dict)
         
-        return jsonify({
+        resposta = {
             'veiculos': veiculos_json,
             'total': len(veiculos_json),
+            'cursor': ate,
             'timestamp': datetime.now().isoformat()
-        })
+        }
+        if since is not None:
+            resposta['since'] = since
+            resposta['removidos'] = removidos
+        
+        return jsonify(resposta)
     except Exception as e:
         return jsonify({
             'veiculos': [],
@@ -841,10 +2258,12 @@ def xml_endpoint():
             'timestamp': datetime.now().isoformat()
         })
 
-@app.route('/json')
-def json_endpoint():
-    return xml_endpoint()
-
 if __name__ == '__main__':
     init_db()
+    
+    # Execução agendada (cron): python app.py gc-fotos [--executar]
+    if len(sys.argv) > 1 and sys.argv[1] == 'gc-fotos':
+        print(json.dumps(coletar_fotos_orfas(dry_run='--executar' not in sys.argv), indent=2))
+        sys.exit(0)
+    
     app.run(debug=True, host='0.0.0.0', port=5000)
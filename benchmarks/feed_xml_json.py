@@ -0,0 +1,114 @@
+# Benchmark offline do feed XML (streaming) contra o /json (lista em memória)
+#
+# Não precisa de banco: troca a conexão e o repositório por versões em memória
+# com linhas sintéticas no mesmo formato que o Postgres devolve, e mede as duas
+# rotas pelo test client do Flask (tempo, pico de memória e tamanho da resposta).
+#
+#   python benchmarks/feed_xml_json.py --veiculos 20000 --repeticoes 3
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import app as integrador
+
+MARCAS = ['Fiat', 'Volkswagen', 'Chevrolet', 'Toyota', 'Honda', 'Hyundai']
+CORES = ['Branco', 'Preto', 'Prata', 'Vermelho', 'Cinza']
+
+def veiculo_sintetico(i):
+    criado = datetime(2024, 1, 1) + timedelta(minutes=i)
+    return integrador.Veiculo(
+        id=i, tipo='carros', marca_id=i % 60, marca_nome=MARCAS[i % len(MARCAS)],
+        modelo_id=i % 900, modelo_nome=f'Modelo {i % 900}', versao_id=i % 3000,
+        versao_nome=f'{i % 900}.0 Flex {i % 4 + 2}p Mec.\x0b', ano_modelo=2010 + i % 15,
+        ano_fabricacao=2010 + i % 15, km=i * 37 % 200000, cor=CORES[i % len(CORES)],
+        combustivel='Flex', cambio='Manual', motor='1.0', portas=4, categoria='Hatch',
+        cilindrada=None, preco=Decimal(30000 + i % 90000) + Decimal('0.90'),
+        fotos=[f'https://cdn.exemplo.com/fotos/{i:08x}{n}.jpg' for n in range(8)],
+        ativo=True, created_at=criado, updated_at=criado
+    )
+
+class CursorMemoria:
+    # Imita o cursor nomeado: entrega as linhas sob demanda, sem materializar a lista
+    def __init__(self, veiculos, colunas):
+        self.veiculos = veiculos
+        self.colunas = colunas
+        self.itersize = 0
+
+    def execute(self, sql, params=()):
+        pass
+
+    def __iter__(self):
+        for i in range(1, self.veiculos + 1):
+            veiculo = veiculo_sintetico(i)
+            yield (i, False) + tuple(getattr(veiculo, coluna) for coluna in self.colunas)
+
+    def close(self):
+        pass
+
+class ConexaoMemoria:
+    replica = None
+
+    def __init__(self, veiculos, colunas):
+        self.veiculos = veiculos
+        self.colunas = colunas
+
+    def cursor(self, name=None):
+        return CursorMemoria(self.veiculos, self.colunas)
+
+    def close(self):
+        pass
+
+def colunas_xml(perfil):
+    config = integrador.XML_PERFIS[perfil]
+    colunas = [coluna for coluna, _ in config['campos']]
+    if config.get('fotos'):
+        colunas.append('fotos')
+    return colunas + ['created_at']
+
+def preparar(veiculos, perfil):
+    integrador.cursor_alteracoes = lambda conn: veiculos
+    integrador.get_db_connection = lambda leitura=False: ConexaoMemoria(veiculos, colunas_xml(perfil))
+
+    def feed(since=None):
+        linhas = [(i, False) + tuple(veiculo_sintetico(i)) for i in range(1, veiculos + 1)]
+        return veiculos, linhas
+    integrador.RepositorioVeiculos.feed = staticmethod(feed)
+
+def medir(cliente, url):
+    tracemalloc.start()
+    inicio = time.perf_counter()
+    resposta = cliente.get(url)
+    tamanho = sum(len(bloco) for bloco in resposta.response)
+    resposta.close()
+    duracao = time.perf_counter() - inicio
+    _, pico = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return duracao, pico, tamanho
+
+def main():
+    parser = argparse.ArgumentParser(description='Compara o feed XML em streaming com o /json')
+    parser.add_argument('--veiculos', type=int, default=5000)
+    parser.add_argument('--repeticoes', type=int, default=3)
+    parser.add_argument('--formato', default='generico', choices=list(integrador.XML_PERFIS))
+    args = parser.parse_args()
+
+    preparar(args.veiculos, args.formato)
+    cliente = integrador.app.test_client()
+
+    print(f'{args.veiculos} veículos, melhor de {args.repeticoes} execuções')
+    for nome, url in (('xml', f'/xml?formato={args.formato}'), ('json', '/json')):
+        resultados = [medir(cliente, url) for _ in range(args.repeticoes)]
+        duracao = min(r[0] for r in resultados)
+        pico = min(r[1] for r in resultados)
+        tamanho = resultados[0][2]
+        print(f'{nome:>5}: {duracao * 1000:9.1f} ms  pico {pico / 1024 / 1024:7.2f} MiB  '
+              f'resposta {tamanho / 1024 / 1024:7.2f} MiB')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+# Micro-benchmark offline das linhas da camada de acesso a dados
+#
+# Compara o formato antigo (RealDictRow, como o RealDictCursor devolvia) com as
+# namedtuples do RepositorioVeiculos/RepositorioCatalogo nos três caminhos quentes:
+# painel (renderização do template), feed JSON e cascata da FIPE. Não precisa de
+# banco: as linhas sintéticas são montadas como o psycopg2 montaria.
+#
+# Mede só o custo de montar e consumir as linhas no Python. Não mede o ganho por
+# requisição dos prepared statements nem as idas e voltas ao banco no checkout do
+# pool; isso só aparece contra um Postgres de verdade.
+#
+#   python benchmarks/linhas_dal.py --linhas 5000 --repeticoes 5
+import argparse
+import json
+import os
+import sys
+import timeit
+import tracemalloc
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+from psycopg2.extras import RealDictRow
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import app as integrador
+from flask import render_template
+
+def valores_veiculo(i):
+    criado = datetime(2024, 1, 1) + timedelta(minutes=i)
+    return (
+        i, 'carros', i % 60, f'Marca {i % 60}', i % 900, f'Modelo {i % 900}', i % 3000,
+        f'{i % 900}.0 Flex 4p Mec.', 2010 + i % 15, 2010 + i % 15, i * 37 % 200000, 'Prata',
+        'Flex', 'Manual', '1.0', 4, 'Hatch', None, Decimal(30000 + i % 90000),
+        [f'https://cdn.exemplo.com/fotos/{i:08x}{n}.jpg' for n in range(4)],
+        i % 7 != 0, criado, criado
+    )
+
+def linhas_tupla(n):
+    # O que o cursor padrão entrega: uma tupla por linha
+    return [valores_veiculo(i) for i in range(1, n + 1)]
+
+def como_dict(campos, linhas):
+    # O que o RealDictCursor entregava para as mesmas linhas
+    return [RealDictRow(zip(campos, linha)) for linha in linhas]
+
+RESUMO_INDICES = [integrador.Veiculo._fields.index(campo) for campo in integrador.VeiculoResumo._fields]
+
+def resumo(linha):
+    # Colunas do painel (VeiculoResumo) a partir de uma linha completa
+    return tuple(linha[i] for i in RESUMO_INDICES)
+
+# Painel
+def painel_dict(linhas):
+    veiculos = como_dict(integrador.VeiculoResumo._fields, [resumo(linha) for linha in linhas])
+    return render_template('dashboard.html', veiculos=veiculos, client_table=integrador.CLIENT_TABLE)
+
+def painel_tupla(linhas):
+    veiculos = list(map(integrador.VeiculoResumo._make, [resumo(linha) for linha in linhas]))
+    return render_template('dashboard.html', veiculos=veiculos, client_table=integrador.CLIENT_TABLE)
+
+# Feed JSON
+def feed_dict(linhas):
+    veiculos = []
+    for row in como_dict(integrador.Veiculo._fields, linhas):
+        veiculo = dict(row)
+        veiculo['created_at'] = veiculo['created_at'].isoformat()
+        veiculo['updated_at'] = veiculo['updated_at'].isoformat()
+        veiculos.append(veiculo)
+    return json.dumps(veiculos, default=str)
+
+def feed_tupla(linhas):
+    veiculos = []
+    for valores in linhas:
+        veiculo = dict(zip(integrador.Veiculo._fields, valores))
+        veiculo['created_at'] = veiculo['created_at'].isoformat()
+        veiculo['updated_at'] = veiculo['updated_at'].isoformat()
+        veiculos.append(veiculo)
+    return json.dumps(veiculos, default=str)
+
+# Cascata da FIPE (/api/modelos)
+def cascata_dict(linhas):
+    rows = como_dict(('modelo_id', 'modelo_nome'), [(linha[4], linha[5]) for linha in linhas])
+    return json.dumps([{'codigo': row['modelo_id'], 'nome': row['modelo_nome']} for row in rows])
+
+def cascata_tupla(linhas):
+    rows = [(linha[4], linha[5]) for linha in linhas]
+    return json.dumps([{'codigo': codigo, 'nome': nome} for codigo, nome in rows])
+
+CAMINHOS = [
+    ('painel', painel_dict, painel_tupla),
+    ('feed_json', feed_dict, feed_tupla),
+    ('cascata', cascata_dict, cascata_tupla)
+]
+
+def memoria_linhas(construir):
+    tracemalloc.start()
+    linhas = construir()
+    atual, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del linhas
+    return atual
+
+def main():
+    parser = argparse.ArgumentParser(description='Compara RealDictRow com namedtuple nas rotas quentes')
+    parser.add_argument('--linhas', type=int, default=5000)
+    parser.add_argument('--repeticoes', type=int, default=5)
+    args = parser.parse_args()
+
+    linhas = linhas_tupla(args.linhas)
+    print(f'{args.linhas} linhas, melhor de {args.repeticoes} execuções')
+
+    with integrador.app.test_request_context('/'):
+        for nome, antigo, novo in CAMINHOS:
+            tempo_antigo = min(timeit.repeat(lambda: antigo(linhas), number=1, repeat=args.repeticoes))
+            tempo_novo = min(timeit.repeat(lambda: novo(linhas), number=1, repeat=args.repeticoes))
+            print(f'{nome:>10}: dict {tempo_antigo * 1000:8.1f} ms  namedtuple {tempo_novo * 1000:8.1f} ms  '
+                  f'({tempo_antigo / tempo_novo:.2f}x)')
+
+    memoria_dict = memoria_linhas(lambda: como_dict(integrador.Veiculo._fields, linhas))
+    memoria_tupla = memoria_linhas(lambda: list(map(integrador.Veiculo._make, linhas)))
+    print(f'{"memória":>10}: dict {memoria_dict / 1024 / 1024:8.2f} MiB  '
+          f'namedtuple {memoria_tupla / 1024 / 1024:8.2f} MiB  (linhas Veiculo em memória)')
+
+if __name__ == '__main__':
+    main()